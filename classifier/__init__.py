@@ -1,8 +1,7 @@
 from classifier import stopwords
-from nltk.probability import FreqDist
-from nltk.stem.porter import PorterStemmer
-from nltk.tokenize.treebank import TreebankWordTokenizer
+from collections import OrderedDict
 import re
+import threading
 class TrainFailureException(Exception):
     def __init__(self, value):
         self.message = value
@@ -18,29 +17,120 @@ class ClassifierFailureException(Exception):
         return repr(self.message)
     
     
+'''
+Bounded least recently used cache with hit/miss statistics, safe to share between threads.
+'''
+class LRUCache(object):
+    
+    def __init__(self, maxSize=10000):
+        self.__maxSize = maxSize
+        self.__cache = OrderedDict()
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key, default=None):
+        with self.__lock :
+            try :
+                value = self.__cache.pop(key)
+            except KeyError :
+                self.misses += 1
+                return default
+            # re-insert to mark it as the most recently used
+            self.__cache[key] = value
+            self.hits += 1
+            return value
+    
+    def put(self, key, value):
+        with self.__lock :
+            self.__cache.pop(key, None)
+            self.__cache[key] = value
+            while len(self.__cache) > self.__maxSize :
+                try :
+                    self.__cache.popitem(last=False)
+                except KeyError :
+                    break
+    
+    def clear(self):
+        with self.__lock :
+            self.__cache.clear()
+            self.hits = 0
+            self.misses = 0
+    
+    def getStats(self):
+        with self.__lock :
+            return {'hits' : self.hits, 'misses' : self.misses, 
+                    'size' : len(self.__cache), 'maxSize' : self.__maxSize}
+    
+    
 class FeatureExtractor(object):
     
-    def __init__(self, maxFeatures=-1): 
+    __onlyLettersNumbers = re.compile('[^a-zA-Z0-9%!]')
+    __sharedExtractor = None
+    __sharedLock = threading.Lock()
+    
+    def __init__(self, maxFeatures=-1, stemCacheSize=50000): 
         self.__maxFeatures = maxFeatures
+        self.__stemmer = None
+        self.__tokenizer = None
+        self.__stemCache = LRUCache(stemCacheSize)
+        self.__stemLock = threading.Lock()
+    
+    '''
+    Returns the default extractor shared by trainers and classifiers, so the 
+    stem cache stays warm across instances.
+    '''
+    @staticmethod
+    def getSharedExtractor():
+        if FeatureExtractor.__sharedExtractor is None :
+            with FeatureExtractor.__sharedLock :
+                if FeatureExtractor.__sharedExtractor is None :
+                    FeatureExtractor.__sharedExtractor = FeatureExtractor()
+        return FeatureExtractor.__sharedExtractor
+    
+    '''
+    NLTK is imported when the first features are extracted, so processes that load
+    the app but never train or classify don't pay for it
+    '''
+    def __loadNltk(self):
+        with self.__stemLock :
+            if self.__tokenizer is None :
+                from nltk.stem.porter import PorterStemmer
+                from nltk.tokenize.treebank import TreebankWordTokenizer
+                self.__stemmer = PorterStemmer()
+                self.__tokenizer = TreebankWordTokenizer()
+    
+    def getStemCacheStats(self):
+        return self.__stemCache.getStats()
+    
+    def __stem(self, word):
+        stem = self.__stemCache.get(word)
+        if stem is None :
+            # The porter stemmer keeps the word being stemmed on itself
+            with self.__stemLock :
+                stem = self.__stemmer.stem_word(word)
+            self.__stemCache.put(word, stem)
+        return stem
     
     '''
-    Given a corpus of text, returns the features
+    Given a corpus of text, returns the features ordered by decreasing frequency
     '''
     def getFeatures(self, corpus):
-        stemmer = PorterStemmer()
-        stems = FreqDist()
-        onlyLettersNumbers = re.compile('[^a-zA-Z0-9%!]')
-        corpus = onlyLettersNumbers.sub(' ', corpus.lower())
-        corpus = TreebankWordTokenizer().tokenize(corpus)
+        if self.__tokenizer is None :
+            self.__loadNltk()
+        stems = {}
+        corpus = self.__onlyLettersNumbers.sub(' ', corpus.lower())
+        corpus = self.__tokenizer.tokenize(corpus)
         
         count = 0
         for word in corpus :
             if not stopwords.STOP_WORDS.get(word) and len(word.strip()) > 1 :
-                stems.inc(stemmer.stem_word(word))
+                stem = self.__stem(word)
+                stems[stem] = stems.get(stem, 0) + 1
                 count += 1
                 if self.__maxFeatures > 0 and count >= self.__maxFeatures :
                     break
                 
-        features = stems.samples()
+        features = sorted(stems, key=stems.get, reverse=True)
         
-        return features
\ No newline at end of file
+        return features
@@ -3,37 +3,212 @@ Created on Feb 10, 2012
 
 @author: Dannie
 '''
-from classifier import FeatureExtractor
-from classifier.models import ClassifierCategory, Document, \
-    CategoryDocumentCountIndex, FeatureCounts
-from json.decoder import JSONDecoder
+from array import array
+from classifier import FeatureExtractor, ClassifierFailureException, LRUCache, \
+    scoring
+from classifier.models import ClassifierCategory, CategoryRegistry, Document, \
+    FeatureCategoryCount, ClassifierModelVersion, CountChangeLog
+from classifier.snapshot import ModelSnapshot, encodeFeatureName
+from django.conf import settings
+import bisect
+import hashlib
 import logging
 import math
+import os
+import threading
+import time
 
+NEGATIVE_INFINITY = float('-inf')
+# Times the counts are read again when count changes keep being committed meanwhile
+LOAD_ATTEMPTS = 3
+
+'''
+Cache of classification results, so identical texts classified again (reposts,
+retries) skip feature extraction and scoring.  Results are kept in a bounded in
+process LRU (CLASSIFIER_RESULT_CACHE_SIZE) and, when CLASSIFIER_RESULT_CACHE_BACKEND
+names one of the django CACHES, in that cache as well.  The keys include the model
+version so training invalidates every cached result.
+'''
+class ClassificationResultCache(object):
+    
+    __sharedCache = None
+    __sharedLock = threading.Lock()
+    
+    def __init__(self, maxSize=10000, backend=None):
+        self.__localCache = LRUCache(maxSize)
+        self.__backend = None
+        if backend :
+            from django.core.cache import get_cache
+            self.__backend = get_cache(backend)
+    
+    @staticmethod
+    def getSharedCache():
+        if ClassificationResultCache.__sharedCache is None :
+            with ClassificationResultCache.__sharedLock :
+                if ClassificationResultCache.__sharedCache is None :
+                    ClassificationResultCache.__sharedCache = ClassificationResultCache(
+                        getattr(settings, 'CLASSIFIER_RESULT_CACHE_SIZE', 10000),
+                        getattr(settings, 'CLASSIFIER_RESULT_CACHE_BACKEND', None))
+        return ClassificationResultCache.__sharedCache
+    
+    '''
+    Key of a corpus classified by a classifier configuration against a model version,
+    hashed so it is a valid key for every cache backend
+    '''
+    @staticmethod
+    def getKey(corpusHash, classifierKey, version):
+        key = hashlib.md5()
+        key.update(repr((classifierKey, version)))
+        return "classifier:%s:%s" % (corpusHash, key.hexdigest())
+    
+    def get(self, key):
+        result = self.__localCache.get(key)
+        if result is None and self.__backend is not None :
+            result = self.__backend.get(key)
+            if result is not None :
+                self.__localCache.put(key, result)
+        return list(result) if result is not None else None
+    
+    def put(self, key, result):
+        result = tuple(result)
+        self.__localCache.put(key, result)
+        if self.__backend is not None :
+            self.__backend.set(key, result)
+    
+    def clear(self):
+        self.__localCache.clear()
+    
+    def getStats(self):
+        return self.__localCache.getStats()
+
+
+'''
+State of a single classification.  It is kept out of the classifier, so one configured
+classifier can be shared by all the threads of a process.
+'''
+class Classification(object):
+    
+    def __init__(self, corpus, features, classifierIndex):
+        self.corpus = corpus
+        self.features = features
+        self.classifierIndex = classifierIndex
+        # Prior only fisher probability, the same for every category without evidence
+        self.priorOnlyProb = None
+        self.__featureCounts = {}
+    
+    '''
+    Counts of a feature keyed by category id.  Every tag is scored against the same
+    features, so they are read from the index (decoded, for the compact index) once.
+    '''
+    def getFeatureCounts(self, feature):
+        counts = self.__featureCounts.get(feature)
+        if counts is None :
+            counts = self.__featureCounts[feature] = self.classifierIndex.getFeatureCounts(feature)
+        return counts
+    
+    
 class Classifier(object):
     
     def __init__(self):
         self.savedCategories = None
-        self._corpus = ""
-        self._features = []
-        self._classifierIndex = None
+        self._useSharedIndex = True
+        self._useCompactIndex = getattr(settings, 'CLASSIFIER_COMPACT_INDEX', False)
+        self._snapshotPath = getattr(settings, 'CLASSIFIER_SNAPSHOT_PATH', None)
+        self._useVectorizedScoring = False
+        self._vectorizedScorer = None
+        self._resultCache = None
+        self._countStore = None
         self._mins = {}
-        self.__featureExtractor = FeatureExtractor()
-    
-    def _getCorpusShort(self):
-        return self._corpus[:50] if self._corpus else ""
-    
-    def _getGroupedCategories(self, categories):
-        groupedCategories = {}
-        for category in categories :
-            if not groupedCategories.get(category.categoryName) :
-                groupedCategories[category.categoryName] = {}
-            groupedCategories[category.categoryName][category.yes] = category 
-        return groupedCategories
+        self.__featureExtractor = FeatureExtractor.getSharedExtractor()
     
     def setFeatureExtractor(self, featureExtractor):
         self.__featureExtractor = featureExtractor
     
+    '''
+    When enabled (the default) classification uses the warm process wide index 
+    instead of loading the counts from the database on every call.
+    '''
+    def setUseSharedIndex(self, useSharedIndex):
+        self._useSharedIndex = useSharedIndex
+    
+    '''
+    Classifies against the compiled model snapshot at path (see classify_snapshot)
+    instead of the database, None switches back to the database.
+    '''
+    def setSnapshotPath(self, path):
+        self._snapshotPath = path
+    
+    '''
+    Classifies against the whole model held in memory in flat arrays (see 
+    CompactClassifierIndex) instead of loading the counts of each text's features.
+    '''
+    def setUseCompactIndex(self, useCompactIndex):
+        self._useCompactIndex = useCompactIndex
+    
+    '''
+    Classifies against the counts of a count store (see classifier.stores), for instance
+    a MemoryCountStore trained offline.  None, the default, uses the database with the
+    index options above.
+    '''
+    def setCountStore(self, countStore):
+        self._countStore = countStore
+    
+    def _getClassifierIndex(self, features):
+        if self._countStore is not None :
+            return self._countStore.getClassifierIndex(features)
+        if self._snapshotPath :
+            index = SnapshotClassifierIndex.getSnapshotIndex(self._snapshotPath)
+            index.loadFeatureCountsForCategories(features)
+            return index
+        if self._useCompactIndex :
+            return CompactClassifierIndex.getCompactIndex()
+        if self._useSharedIndex :
+            return ClassifierIndex.getSharedIndex(features)
+        return ClassifierIndex(features)
+    
+    '''
+    Scores all the categories at once with NumPy instead of looping over
+    every feature of every category.
+    '''
+    def setUseVectorizedScoring(self, useVectorizedScoring):
+        if useVectorizedScoring and not scoring.isAvailable() :
+            raise ClassifierFailureException("NumPy is required for vectorized scoring")
+        self._useVectorizedScoring = useVectorizedScoring
+    
+    '''
+    Caches the results of classify by corpus hash, see ClassificationResultCache.
+    True uses the process wide cache, a ClassificationResultCache instance can be
+    given instead and None/False disables caching.
+    '''
+    def setResultCache(self, resultCache):
+        if resultCache is True :
+            resultCache = ClassificationResultCache.getSharedCache()
+        self._resultCache = resultCache or None
+    
+    '''
+    Everything besides the corpus and the model that changes the results
+    '''
+    def _getResultCacheKey(self):
+        thresholds = sorted((categoryName, yes, value) for categoryName, mins in self._mins.items() 
+                            for yes, value in mins.items())
+        # Count stores number their versions independently
+        countStore = id(self._countStore) if self._countStore is not None else None
+        return (self.__class__.__name__, self.__featureExtractor.__class__.__name__, thresholds, countStore)
+    
+    '''
+    Current model version without loading any feature counts
+    '''
+    def _getModelVersion(self):
+        if self._countStore is not None :
+            return self._countStore.getVersion()
+        if self._snapshotPath :
+            return SnapshotClassifierIndex.getSnapshotIndex(self._snapshotPath).getVersion()
+        if self._useCompactIndex :
+            return CompactClassifierIndex.getCompactIndex().getVersion()
+        if self._useSharedIndex :
+            return ClassifierIndex.getSharedIndex([]).getVersion()
+        return ClassifierModelVersion.getVersion()
+    
     def setMinThreshold(self, categoryName, yes, value):
         if not self._mins.get(categoryName) :
             self._mins[categoryName] = {}
@@ -46,44 +221,119 @@ class Classifier(object):
     Classification of text corpus
     '''
     def classify(self, corpus):
-        self._corpus = corpus
-        self._features = self.__featureExtractor.getFeatures(corpus)
-        self._classifierIndex = ClassifierIndex(self._features)
+        if self._resultCache is not None :
+            key = ClassificationResultCache.getKey(Document.getHash(corpus), self._getResultCacheKey(), self._getModelVersion())
+            probableTags = self._resultCache.get(key)
+            if probableTags is None :
+                probableTags = self._classify(corpus)
+                if probableTags :
+                    self._resultCache.put(key, probableTags)
+            return probableTags
+        return self._classify(corpus)
+    
+    def _classify(self, corpus):
+        features = self.__featureExtractor.getFeatures(corpus)
+        classification = Classification(corpus, features, self._getClassifierIndex(features))
     
         # Find the category with the highest probability
         logger = logging.getLogger("Classifier.classify")
         
-        categories = ClassifierCategory.getAllCategories()
-        
-        groupedCategories = self._getGroupedCategories(categories)
+        groupedCategories = classification.classifierIndex.getGroupedCategories()
         probableTags = []
         try :
-            probableTags = self._getProbableTags(groupedCategories)
+            probableTags = self._getProbableTags(classification, groupedCategories)
         except Exception, ex :
             logger.exception("classification failure:  " + str(ex))
 
         return probableTags
+    
+    '''
+    Classification of many text corpora at once.  The feature counts for all of the 
+    corpora are loaded with one query and the categories are loaded once, returns the 
+    probable tags of each corpus in the same order.
+    Features that were already extracted can be passed in corpusFeatures.
+    '''
+    def classifyMany(self, corpora, corpusFeatures=None):
+        logger = logging.getLogger("Classifier.classifyMany")
         
+        corpora = list(corpora)
+        if corpusFeatures is None :
+            corpusFeatures = [self.__featureExtractor.getFeatures(corpus) for corpus in corpora]
+        allFeatures = set()
+        for features in corpusFeatures :
+            allFeatures.update(features)
+        classifierIndex = self._getClassifierIndex(allFeatures)
         
-    def _getProbableTags(self, groupedCategories):
-        logger = logging.getLogger("Classifier._getProbableTags")
-        probableTags = []
+        groupedCategories = classifierIndex.getGroupedCategories()
         
-        for tagName in groupedCategories :
-            yesProb = self._getProb(groupedCategories[tagName], True)
-            noProb = self._getProb(groupedCategories[tagName], False)
-                
-            yesMin = self.getMinThreshold(tagName, True)
-            noMin = self.getMinThreshold(tagName, False)
+        results = []
+        for corpus, features in zip(corpora, corpusFeatures) :
+            classification = Classification(corpus, features, classifierIndex)
+            probableTags = []
+            try :
+                probableTags = self._getProbableTags(classification, groupedCategories)
+            except Exception, ex :
+                logger.exception("classification failure:  " + str(ex))
+            results.append(probableTags)
+            
+        return results
+        
+        
+    def _getProbableTags(self, classification, groupedCategories):
+        return [self._getProbableTag(tagName, yesProb, noProb) 
+                for tagName, yesProb, noProb in self._getTagProbs(classification, groupedCategories)]
     
-            if self._isYesNo(yesProb, noProb, yesMin, noMin) :
-                probableTags.append((tagName, True))
+    '''
+    Returns (tagName, yesProb, noProb) for every tag, before the thresholds are applied
+    '''
+    def _getTagProbs(self, classification, groupedCategories):
+        if self._useVectorizedScoring :
+            return self._getVectorizedTagProbs(classification, groupedCategories)
+        
+        tagProbs = []
+        
+        # Only the categories a feature of the corpus was trained with need to be scored
+        # feature by feature, the others get the prior only probability.
+        evidence = set()
+        for feature in classification.features :
+            evidence.update(classification.getFeatureCounts(feature))
+        
+        for tagName, categoryYesNo in groupedCategories.items() :
+            if categoryYesNo[True].id in evidence or categoryYesNo[False].id in evidence :
+                yesProb, noProb = self._getProbs(classification, categoryYesNo)
             else :
-                probableTags.append((tagName, False))
-                
-            logger.info("Tag:%s = %s v %s" % (tagName, str(yesProb), str(noProb)))
+                yesProb = self._getPriorOnlyProb(classification, classification.classifierIndex.getNumDocumentsForCategory(categoryYesNo[True]))
+                noProb = self._getPriorOnlyProb(classification, classification.classifierIndex.getNumDocumentsForCategory(categoryYesNo[False]))
+            
+            tagProbs.append((tagName, yesProb, noProb))
                 
-        return probableTags
+        return tagProbs
+    
+    '''
+    Returns the yes and no probabilities of a tag, classifiers can override it to
+    score both in a single pass over the features
+    '''
+    def _getProbs(self, classification, categoryYesNo):
+        return self._getProb(classification, categoryYesNo, True), self._getProb(classification, categoryYesNo, False)
+    
+    def _getVectorizedTagProbs(self, classification, groupedCategories):
+        # Threads may build a scorer at the same time, they are equivalent so the last one is kept
+        scorer = self._vectorizedScorer
+        if scorer is None or not scorer.isFor(classification.classifierIndex, groupedCategories) :
+            scorer = self._vectorizedScorer = scoring.VectorizedScorer(classification.classifierIndex, groupedCategories)
+        
+        yesProbs, noProbs = self._getVectorizedProbs(classification, scorer)
+        return zip(scorer.getTagNames(), yesProbs, noProbs)
+    
+    def _getProbableTag(self, tagName, yesProb, noProb):
+        logger = logging.getLogger("Classifier._getProbableTags")
+        
+        yesMin = self.getMinThreshold(tagName, True)
+        noMin = self.getMinThreshold(tagName, False)
+        
+        logger.info("Tag:%s = %s v %s" % (tagName, str(yesProb), str(noProb)))
+        
+        return (tagName, bool(self._isYesNo(yesProb, noProb, yesMin, noMin)))
     
     def __getTagsText(self, tags):
         tagText = ""
@@ -99,43 +349,70 @@ class BayesianClassifier(Classifier):
     def __init__(self):
         super(BayesianClassifier, self).__init__()
     
+    '''
+    Equivalent to log(yesProb/noProb) > 0, but also holds for log probabilities
+    and doesn't fail when either probability is zero.
+    '''
     def _isYesNo(self, yesProb, noProb, yesMin=0, noMin=0):
-        return math.log(yesProb/noProb) > 0
+        return yesProb > noProb
+    
+    '''
+    The vectorized scorer returns log probabilities, which compare the same way
+    '''
+    def _getVectorizedProbs(self, classification, scorer):
+        return scorer.getBayesianLogProbs(classification.features)
        
     
-    def _getProb(self, categoryYesNo, yes):
+    '''
+    Log probability of a category none of the features were trained with, every 
+    feature contributes the assumed probability
+    '''
+    def _getPriorOnlyProb(self, classification, numDocuments):
+        if numDocuments <= 0 :
+            return NEGATIVE_INFINITY
+        return math.log(numDocuments) + len(classification.features) * math.log(0.5)
+    
+    '''
+    Log probability of the category, log(docprob * catprob)
+    '''
+    def _getProb(self, classification, categoryYesNo, yes):
         # Ratio of given category in the trainer database.
-        numDocumentsYes = self._classifierIndex.getNumDocumentsForCategory(categoryYesNo[yes])
+        numDocumentsYes = classification.classifierIndex.getNumDocumentsForCategory(categoryYesNo[yes])
+        
+        if numDocumentsYes <= 0 :
+            return NEGATIVE_INFINITY
         
-        catprob = float(numDocumentsYes)
+        catprob = math.log(numDocumentsYes)
         # Probably of given doc being in the given category.
-        docprob = self.__getDocumentProb(categoryYesNo, yes)
-        return docprob * catprob
+        docprob = self.__getDocumentLogProb(classification, categoryYesNo, yes)
+        return docprob + catprob
     
-    ''' Probablity that given document is in the given category. '''
-    def __getDocumentProb(self, categoryYesNo, yes):
-        # Multiply the probabilities of all the features together
+    ''' Log probablity that given document is in the given category. '''
+    def __getDocumentLogProb(self, classification, categoryYesNo, yes):
+        # Sum the log probabilities of all the features, multiplying them underflows on long documents
         category = categoryYesNo[yes]
-        prob = 0
-        numDocumentsForCategory = self._classifierIndex.getNumDocumentsForCategory(category)
+        categoryIds = [otherCategory.id for otherCategory in categoryYesNo.values()]
+        logProb = NEGATIVE_INFINITY
+        numDocumentsForCategory = classification.classifierIndex.getNumDocumentsForCategory(category)
         
         if numDocumentsForCategory > 0 :
-            prob = 1
-            for feature in self._features : 
+            logProb = 0.0
+            for feature in classification.features : 
                 weight = 1
                 ap = 0.5
                 
-                featureCategoryCount = self._classifierIndex.getFeatureCategoryCount(feature, category)
+                counts = classification.getFeatureCounts(feature)
+                featureCategoryCount = counts.get(category.id, 0)
                 basicProb = float(featureCategoryCount) / float(numDocumentsForCategory)
                 
                 # Count the number of times this feature has appeared in
                 # all categories
-                totals = self._classifierIndex.getTotalFeatureCount(feature, categoryYesNo.values())
+                totals = sum(counts.get(categoryId, 0) for categoryId in categoryIds)
                 
                 # Calculate the weighted average
-                prob *= ((weight * ap) + (totals * basicProb)) / (weight + totals)
+                logProb += math.log(((weight * ap) + (totals * basicProb)) / (weight + totals))
     
-        return prob
+        return logProb
     
 '''
 Passing in minimum probabilities will effect the classification.
@@ -153,48 +430,73 @@ class FisherBayesClassifier(Classifier):
             isYes = False
         return isYes
     
+    def _getVectorizedProbs(self, classification, scorer):
+        return scorer.getFisherProbs(classification.features)
     
-    def _getProb(self, categoryYesNo, yes):
-        # Multiply the probabilities of all the features together
-        category = categoryYesNo[yes]
-        notCategory = categoryYesNo[not yes]
-        prob = 0
-        numDocumentsForCategory = self._classifierIndex.getNumDocumentsForCategory(category)
-        
-        if numDocumentsForCategory > 0 :
-            prob = 1
-            for feature in self._features : 
-                weight = 1
-                ap = 0.5
-                
-                featureCategoryCount = self._classifierIndex.getFeatureCategoryCount(feature, category)
-                basicProb = float(featureCategoryCount) / float(numDocumentsForCategory)
-                
-                if basicProb > 0 :
-                    featureCategoryCount2 = self._classifierIndex.getFeatureCategoryCount(feature, notCategory)
-                    freqSum = basicProb + (float(featureCategoryCount2/float(numDocumentsForCategory)))
-                    basicProb = basicProb/freqSum
-                    
-                # Count the number of times this feature has appeared in
-                # all categories
-                totals = self._classifierIndex.getTotalFeatureCount(feature, categoryYesNo.values())
-                
-                # Calculate the weighted average
-                prob *= ((weight * ap) + (totals * basicProb)) / (weight + totals)
-    
+    '''
+    Fisher probability of a category none of the features were trained with, it
+    only depends on the number of features so it is computed once per corpus
+    '''
+    def _getPriorOnlyProb(self, classification, numDocuments):
+        if numDocuments <= 0 :
+            return 0
+        numFeatures = len(classification.features)
+        if classification.priorOnlyProb is None :
+            classification.priorOnlyProb = self.__invchi2(-2 * numFeatures * math.log(0.5), numFeatures * 2)
+        return classification.priorOnlyProb
     
-        if prob > 0 :
-            prob = self.__invchi2(-2*math.log(prob), len(self._features) * 2)
     
-        return prob
+    '''
+    Scores the yes and the no category in one pass, the counts of each feature are
+    looked up once for both.
+    '''
+    def _getProbs(self, classification, categoryYesNo):
+        yesId = categoryYesNo[True].id
+        noId = categoryYesNo[False].id
+        numDocumentsYes = float(classification.classifierIndex.getNumDocumentsForCategory(categoryYesNo[True]))
+        numDocumentsNo = float(classification.classifierIndex.getNumDocumentsForCategory(categoryYesNo[False]))
+        
+        weight = 1
+        ap = 0.5
+        yesLogProb = 0.0
+        noLogProb = 0.0
+        for feature in classification.features :
+            counts = classification.getFeatureCounts(feature)
+            yesCount = counts.get(yesId, 0)
+            noCount = counts.get(noId, 0)
+            totals = yesCount + noCount
+            
+            if numDocumentsYes > 0 :
+                basicProb = yesCount / numDocumentsYes
+                if basicProb > 0 :
+                    basicProb = basicProb / (basicProb + noCount / numDocumentsYes)
+                yesLogProb += math.log(((weight * ap) + (totals * basicProb)) / (weight + totals))
+            
+            if numDocumentsNo > 0 :
+                basicProb = noCount / numDocumentsNo
+                if basicProb > 0 :
+                    basicProb = basicProb / (basicProb + yesCount / numDocumentsNo)
+                noLogProb += math.log(((weight * ap) + (totals * basicProb)) / (weight + totals))
         
+        df = len(classification.features) * 2
+        yesProb = self.__invchi2(-2 * yesLogProb, df) if numDocumentsYes > 0 else 0
+        noProb = self.__invchi2(-2 * noLogProb, df) if numDocumentsNo > 0 else 0
+        return yesProb, noProb
     
+    '''
+    Inverse chi square, the poisson terms are accumulated in log space so
+    a large chi (long documents) doesn't underflow exp(-m) to zero.
+    '''
     def __invchi2(self, chi, df) :
         m = chi/2.0
-        sum = term = math.exp(-m)
+        if m <= 0 :
+            return 1.0
+        logM = math.log(m)
+        logTerm = -m
+        sum = math.exp(logTerm)
         for i in range(1, df//2) :
-            term *= m / i
-            sum += term
+            logTerm += logM - math.log(i)
+            sum += math.exp(logTerm)
         return min(sum, 1.0)
 
 '''
@@ -205,18 +507,344 @@ class ClassifierIndex(object):
     __featureTagIndex = None
     __documentCountHash = None
     
-    def __init__(self, features):
-        self.__jsonDecoder = JSONDecoder()
+    # Process wide index shared by all classifiers in this worker
+    __sharedIndex = None
+    __sharedLock = threading.Lock()
+    __refreshLock = threading.Lock()
+    __lastVersionCheck = 0
+    
+    def __init__(self, features=None):
         self.__featureTagIndex = {}
+        self.__missingFeatures = set()
         self.__documentCountHash = {}
-        self.loadFeatureCountsForCategories(features)
-        self.loadAllDocumentCounts()
-        self.loadNumberOfDocuments()
+        self.__numberOfDocuments = 0
+        self.__version = None
+        self.__categories = None
+        self.__groupedCategories = None
+        self.__lastSequence = 0
+        self.__appliedSequences = set()
+        self.__loadTime = time.time()
+        self.__stale = False
+        # Bumped whenever counts are changed in place, see getRevision
+        self._revision = 0
+        
+        if features is not None :
+            self.getCategories()
+            self.loadFeatureCountsForCategories(features)
+            self.loadAllDocumentCounts()
+            self.loadNumberOfDocuments()
+    
+    '''
+    Returns the warm, process wide index with the counts for the given features loaded.
+    When training bumps the persisted model version the index applies the count changes
+    logged since (see CountChangeLog), it is only rebuilt when the log asks for it or
+    every CLASSIFIER_INDEX_RELOAD_INTERVAL seconds.  The version itself is checked at 
+    most once every CLASSIFIER_INDEX_CHECK_INTERVAL seconds.
+    Once CLASSIFIER_INDEX_MAX_FEATURES known and unknown features are loaded a fresh 
+    index replaces it, classifications still holding the old one finish with it.
+    The database is read outside of the shared lock, threads whose features are 
+    loaded already keep classifying meanwhile.
+    '''
+    @staticmethod
+    def getSharedIndex(features):
+        index = ClassifierIndex.__getCheckedSharedIndex()
+        if not index.hasUnloadedFeatures(features) :
+            return index
+        
+        if index.getNumberOfFeatures() >= getattr(settings, 'CLASSIFIER_INDEX_MAX_FEATURES', 200000) :
+            ClassifierIndex.__refreshSharedIndex(index, reload=True)
+        
+        # A change committed while the counts are read may or may not be part of them,
+        # it would be applied from the log again later.  Catch up and read them again.
+        for attempt in range(LOAD_ATTEMPTS) :
+            with ClassifierIndex.__sharedLock :
+                index = ClassifierIndex.__sharedIndex
+                position = index.getChangeLogPosition()
+            featureCounts = index.readFeatureCounts(features)
+            isConsistent = index.isChangeLogAt(position)
+            with ClassifierIndex.__sharedLock :
+                if index is ClassifierIndex.__sharedIndex and isConsistent and index.getChangeLogPosition() == position :
+                    index.addFeatureCounts(featureCounts)
+                    return index
+            ClassifierIndex.__refreshSharedIndex(index)
+        
+        with ClassifierIndex.__sharedLock :
+            index.addFeatureCounts(featureCounts)
+            index.setStale()
+        return index
+    
+    '''
+    Returns the shared index, checking the model version when it is due
+    '''
+    @staticmethod
+    def __getCheckedSharedIndex():
+        with ClassifierIndex.__sharedLock :
+            index = ClassifierIndex.__sharedIndex
+            now = time.time()
+            checkInterval = getattr(settings, 'CLASSIFIER_INDEX_CHECK_INTERVAL', 1.0)
+            isDue = index is None or now - ClassifierIndex.__lastVersionCheck >= checkInterval
+            if isDue :
+                # The other threads keep using the current index until it is checked
+                ClassifierIndex.__lastVersionCheck = now
+        
+        if isDue :
+            try :
+                version = ClassifierModelVersion.getVersion()
+            except Exception, ex :
+                raise ClassifyIndexLoadFailure("Failed to load the model version: %s" % str(ex))
+            if index is None or index.getVersion() != version or index.isStale() :
+                ClassifierIndex.__refreshSharedIndex(index, version)
+            with ClassifierIndex.__sharedLock :
+                index = ClassifierIndex.__sharedIndex
+        return index
+    
+    '''
+    Brings the shared index up to date by applying the change log, or replaces it with
+    a new index.  Refreshes run one at a time and read the database outside the shared 
+    lock, nothing happens when the index was replaced meanwhile.
+    '''
+    @staticmethod
+    def __refreshSharedIndex(index, version=None, reload=False):
+        with ClassifierIndex.__refreshLock :
+            if index is not ClassifierIndex.__sharedIndex :
+                return
+            
+            changes = None
+            if index is not None and not reload :
+                changes = index.readChangeLog()
+            if changes is None :
+                if version is None :
+                    version = index.getVersion()
+                newIndex = ClassifierIndex.__loadSharedIndex(version)
+                with ClassifierIndex.__sharedLock :
+                    ClassifierIndex.__sharedIndex = newIndex
+            else :
+                with ClassifierIndex.__sharedLock :
+                    index.applyChanges(changes)
+                    if version is not None :
+                        index.__version = version
+    
+    @staticmethod
+    def __loadSharedIndex(version):
+        logger = logging.getLogger("ClassifierIndex.getSharedIndex")
+        logger.info("loading classifier index for model version %s" % str(version))
+        
+        # Categories trained by other processes show up with the new version
+        CategoryRegistry.getSharedRegistry().invalidate()
+        # Swap in a new index so classifiers still holding the old one are unaffected
+        for attempt in range(LOAD_ATTEMPTS) :
+            index = ClassifierIndex()
+            index.__version = version
+            index.startChangeLog()
+            position = index.getChangeLogPosition()
+            index.loadAllDocumentCounts()
+            index.loadNumberOfDocuments()
+            if index.isChangeLogAt(position) :
+                break
+        else :
+            logger.info("count changes kept being committed while loading, reloading on the next check")
+            index.setStale()
+        return index
+    
+    '''
+    Drops the process wide index, the next classification reloads it from the database
+    '''
+    @staticmethod
+    def resetSharedIndex():
+        with ClassifierIndex.__sharedLock :
+            ClassifierIndex.__sharedIndex = None
+            ClassifierIndex.__lastVersionCheck = 0
+    
+    def getVersion(self):
+        return self.__version
+    
+    '''
+    Changes every time count changes are applied to the loaded counts, anything built
+    from the counts (see VectorizedScorer) is stale once it changed
+    '''
+    def getRevision(self):
+        return self._revision
+    
+    '''
+    A stale index may hold counts that don't match its change log position, it is 
+    reloaded on the next version check
+    '''
+    def isStale(self):
+        return self.__stale
+    
+    def setStale(self):
+        self.__stale = True
+    
+    '''
+    Remembers the position in the change log, called before the counts are loaded.
+    The latest CLASSIFIER_CHANGE_LOG_WINDOW sequence numbers are kept because changes
+    can commit out of order, the ones already committed are part of the loaded counts.
+    '''
+    def startChangeLog(self):
+        try :
+            self.__lastSequence = CountChangeLog.getLastSequence()
+            window = getattr(settings, 'CLASSIFIER_CHANGE_LOG_WINDOW', 100)
+            self.__appliedSequences = set(CountChangeLog.getSequencesSince(self.__lastSequence - window))
+        except Exception, ex :
+            raise ClassifyIndexLoadFailure("Failed to read the count change log: %s" % str(ex))
+        self.__loadTime = time.time()
+    
+    '''
+    The position in the change log the loaded counts correspond to
+    '''
+    def getChangeLogPosition(self):
+        return self.__lastSequence, frozenset(self.__appliedSequences)
+    
+    '''
+    True when no change was committed since the position was taken.  Counts read in
+    between only match the position then, a change committed meanwhile may or may not
+    be part of them.
+    '''
+    def isChangeLogAt(self, position):
+        lastSequence, appliedSequences = position
+        window = getattr(settings, 'CLASSIFIER_CHANGE_LOG_WINDOW', 100)
+        try :
+            sequences = CountChangeLog.getSequencesSince(lastSequence - window)
+        except Exception, ex :
+            raise ClassifyIndexLoadFailure("Failed to read the count change log: %s" % str(ex))
+        for sequence in sequences :
+            if sequence not in appliedSequences :
+                return False
+        return True
+    
+    '''
+    Applies the count changes logged since the last call.  Returns False when the
+    index has to be reloaded instead.
+    '''
+    def applyChangeLog(self):
+        changes = self.readChangeLog()
+        if changes is None :
+            return False
+        self.applyChanges(changes)
+        return True
+    
+    '''
+    Reads the count changes logged since the last applied ones without applying them,
+    returns None when the index has to be reloaded instead
+    '''
+    def readChangeLog(self):
+        logger = logging.getLogger("ClassifierIndex.applyChangeLog")
+        
+        if self.__stale or time.time() - self.__loadTime >= getattr(settings, 'CLASSIFIER_INDEX_RELOAD_INTERVAL', 3600) :
+            return None
+        
+        window = getattr(settings, 'CLASSIFIER_CHANGE_LOG_WINDOW', 100)
+        try :
+            sequences = [sequence for sequence in CountChangeLog.getSequencesSince(self.__lastSequence - window) 
+                         if sequence not in self.__appliedSequences]
+            changes = list(CountChangeLog.getChanges(sequences)) if sequences else []
+        except Exception, ex :
+            logger.exception("Failed to read the count change log: %s" % str(ex))
+            return None
+        
+        for change in changes :
+            if change.reload :
+                return None
+        return changes
+    
+    '''
+    Applies changes read with readChangeLog, the ones applied meanwhile are skipped
+    '''
+    def applyChanges(self, changes):
+        window = getattr(settings, 'CLASSIFIER_CHANGE_LOG_WINDOW', 100)
+        appliedSequences = set(self.__appliedSequences)
+        for change in changes :
+            if change.id in appliedSequences :
+                continue
+            self.applyCountChanges(change.getFeatureDeltas(), change.getCategoryDeltas(), change.documentsDelta)
+            appliedSequences.add(change.id)
+            self.__lastSequence = max(self.__lastSequence, change.id)
+        
+        self.__appliedSequences = set(sequence for sequence in appliedSequences 
+                                      if sequence > self.__lastSequence - window)
+    
+    '''
+    Applies {featureName : {categoryId : delta}} and {categoryId : delta} to the loaded
+    counts.  Classifying threads may be reading them, so changed dicts are replaced
+    rather than modified.
+    '''
+    def applyCountChanges(self, featureDeltas, categoryDeltas, documentsDelta):
+        for featureName, deltas in featureDeltas.items() :
+            counts = self.__featureTagIndex.get(featureName)
+            if counts is None :
+                if featureName not in self.__missingFeatures :
+                    # Not loaded yet, it is read from the database when needed
+                    continue
+                self.__missingFeatures.discard(featureName)
+                counts = {}
+            self.__featureTagIndex[featureName] = self._addDeltas(counts, deltas)
+        
+        if [categoryId for categoryId in categoryDeltas if categoryId not in self.__documentCountHash] :
+            self._resetCategories()
+        self.__documentCountHash = self._addDeltas(self.__documentCountHash, categoryDeltas)
+        self.__numberOfDocuments = max(self.__numberOfDocuments + documentsDelta, 0)
+        self._revision += 1
+    
+    def _addDeltas(self, counts, deltas):
+        counts = dict(counts)
+        for categoryId, delta in deltas.items() :
+            counts[categoryId] = max(counts.get(categoryId, 0) + delta, 0)
+        return counts
+    
+    '''
+    New categories were trained, the categories are reloaded on the next classification
+    '''
+    def _resetCategories(self):
+        CategoryRegistry.getSharedRegistry().invalidate()
+        self.__categories = None
+        self.__groupedCategories = None
+    
+    '''
+    Number of loaded features, known or not
+    '''
+    def getNumberOfFeatures(self):
+        return len(self.__featureTagIndex) + len(self.__missingFeatures)
+    
+    def hasUnloadedFeatures(self, features):
+        for feature in features :
+            if feature not in self.__featureTagIndex and feature not in self.__missingFeatures :
+                return True
+        return False
+    
+    '''
+    The count store the index reads the categories and counts from, the database
+    '''
+    def _getCountStore(self):
+        # stores imports this module
+        from classifier.stores import DjangoCountStore
+        return DjangoCountStore.getSharedStore()
+    
+    '''
+    Retrieves all the categories to classify against, loaded once per index
+    '''
+    def getCategories(self):
+        if self.__categories is None :
+            try :
+                self.__categories = self._getCountStore().getAllCategories()
+            except Exception, ex :
+                raise ClassifyIndexLoadFailure("Failed to load the categories: %s" % str(ex))
+        return self.__categories
+    
+    '''
+    The categories grouped as {categoryName : {yes : category}}, built once per index
+    '''
+    def getGroupedCategories(self):
+        if self.__groupedCategories is None :
+            groupedCategories = {}
+            for category in self.getCategories() :
+                groupedCategories.setdefault(category.categoryName, {})[category.yes] = category
+            self.__groupedCategories = groupedCategories
+        return self.__groupedCategories
 
     def loadNumberOfDocuments(self):
         logger = logging.getLogger("ClassifierIndex.loadNumberOfDocuments")
         try :
-            self.__numberOfDocuments = Document.objects.count()
+            self.__numberOfDocuments = self._getCountStore().getNumberOfDocuments()
         except Exception, ex :
             logger.exception("Failed to load number of documents: " + str(ex))
             raise ClassifyIndexLoadFailure("Failed to load number of documents: " + str(ex))
@@ -224,8 +852,7 @@ class ClassifierIndex(object):
     def loadAllDocumentCounts(self):
         logger = logging.getLogger("ClassifierIndex.loadAllDocumentCounts")
         try :
-            countIndex = CategoryDocumentCountIndex.getCountIndex()
-            self.__documentCountHash = self.__jsonDecoder.decode(countIndex.countData) if countIndex.countData else {}
+            self.__documentCountHash = self._getCountStore().getDocumentCounts()
         except Exception, ex :
             logger.exception("Failed to load all documents counts: " + str(ex))
             raise ClassifyIndexLoadFailure("Failed to load all document counts: " + str(ex))
@@ -234,28 +861,49 @@ class ClassifierIndex(object):
     Caches the feature counts for all top-level categories
     Constructs the following index to improve to calculations:
     index[featureName][tagId][categoryId]=count
+    Features that were already loaded (or are known not to exist) are not queried again.
     '''  
     def loadFeatureCountsForCategories(self, features, categoryIds=[0]):
+        self.addFeatureCounts(self.readFeatureCounts(features))
+    
+    '''
+    Reads the counts of the features that aren't loaded yet without adding them,
+    returns {featureName : {categoryId : count}} with empty counts for unknown features
+    '''
+    def readFeatureCounts(self, features):
         logger = logging.getLogger("ClassifierIndex.loadAllFeatureCounts")
         
+        featureCounts = dict((feature, {}) for feature in features 
+                             if feature not in self.__featureTagIndex and feature not in self.__missingFeatures)
+        if not featureCounts :
+            return featureCounts
+        
         logger.info("loading all feature counts")
         try :
-            features = FeatureCounts.objects.filter(featureName__in=features)
-        
-            if features :
-                for feature in features :
-                    index = self.__jsonDecoder.decode(feature.countData) if feature.countData else {}
-                    self.__featureTagIndex[feature.featureName] = index
-
+            for featureName, categoryId, count in self._getCountStore().getCountsByFeatureNames(featureCounts.keys()) :
+                featureCounts[featureName][categoryId] = count
         except Exception, ex :
             raise ClassifyIndexLoadFailure("Failed to load the feature counts!: %s " % str(ex))
+        return featureCounts
+    
+    '''
+    Adds counts read with readFeatureCounts, features loaded meanwhile are kept
+    '''
+    def addFeatureCounts(self, featureCounts):
+        for featureName, counts in featureCounts.items() :
+            if featureName in self.__featureTagIndex or featureName in self.__missingFeatures :
+                continue
+            if counts :
+                self.__featureTagIndex[featureName] = counts
+            else :
+                self.__missingFeatures.add(featureName)
         
             
     '''
     Retrieves the total number of documents that have been trained for a given category
     '''
     def getNumDocumentsForCategory(self, category):
-        count = self.__documentCountHash.get(str(category.id))
+        count = self.__documentCountHash.get(category.id)
         return count if count else 0
             
     '''
@@ -264,21 +912,329 @@ class ClassifierIndex(object):
     def getNumberOfDocuments(self):
         return self.__numberOfDocuments 
     
+    '''
+    Retrieves the counts of a feature for all categories, keyed by category id
+    '''
+    def getFeatureCounts(self, featureName):
+        return self.__featureTagIndex.get(featureName) or {}
+    
     '''
     Retrieves the total feature counts for a particular classifier category
     '''
     def getFeatureCategoryCount(self, featureName, category):
         index = self.__featureTagIndex.get(featureName)
-        return index.get(str(category.id), 0) if index else 0
+        return index.get(category.id, 0) if index else 0
     
     '''
     Retrieves the total feature counts for the classifier category Yes and No
     '''
     def getTotalFeatureCount(self, featureName, categoriesYesNo) :
         index = self.__featureTagIndex.get(featureName)
-        return index.get(str(categoriesYesNo[0].id), 0) + index.get(str(categoriesYesNo[1].id), 0) if index else 0
+        return index.get(categoriesYesNo[0].id, 0) + index.get(categoriesYesNo[1].id, 0) if index else 0
           
           
+'''
+Classifier index backed by a compiled model snapshot (see classifier.snapshot).  The 
+snapshot is mmap'ed read only so all worker processes share its pages, classifying with
+this index never touches the database.
+'''
+class SnapshotClassifierIndex(ClassifierIndex):
+    
+    # One index per snapshot path shared by all classifiers in this worker
+    __sharedIndexes = {}
+    __sharedLock = threading.Lock()
+    
+    def __init__(self, path):
+        super(SnapshotClassifierIndex, self).__init__()
+        try :
+            self.__snapshot = ModelSnapshot(path)
+        except Exception, ex :
+            raise ClassifyIndexLoadFailure("Failed to load the snapshot %s: %s" % (path, str(ex)))
+        
+        self.__featureCache = LRUCache(getattr(settings, 'CLASSIFIER_SNAPSHOT_CACHE_SIZE', 100000))
+        self.__lastCheck = time.time()
+        self.__documentCountHash = {}
+        self.__categories = []
+        for categoryId, categoryName, yes, documentCount in self.__snapshot.categories :
+            self.__documentCountHash[categoryId] = documentCount
+            self.__categories.append(ClassifierCategory(id=categoryId, categoryName=categoryName, yes=yes))
+    
+    '''
+    Returns the shared index for the snapshot at path.  The snapshot file is checked for
+    changes at most once every CLASSIFIER_INDEX_CHECK_INTERVAL seconds and remapped when 
+    classify_snapshot replaced it.
+    '''
+    @staticmethod
+    def getSnapshotIndex(path):
+        logger = logging.getLogger("SnapshotClassifierIndex.getSnapshotIndex")
+        
+        with SnapshotClassifierIndex.__sharedLock :
+            index = SnapshotClassifierIndex.__sharedIndexes.get(path)
+            now = time.time()
+            checkInterval = getattr(settings, 'CLASSIFIER_INDEX_CHECK_INTERVAL', 1.0)
+            
+            if index is None or now - index.__lastCheck >= checkInterval :
+                if index is None or index.__isStale() :
+                    logger.info("mapping classifier snapshot %s" % path)
+                    index = SnapshotClassifierIndex(path)
+                    SnapshotClassifierIndex.__sharedIndexes[path] = index
+                index.__lastCheck = now
+        
+        return index
+    
+    def __isStale(self):
+        try :
+            return os.stat(self.__snapshot.path).st_mtime != self.__snapshot.mtime
+        except OSError :
+            return False
+    
+    def getVersion(self):
+        return self.__snapshot.version
+    
+    def getCategories(self):
+        return self.__categories
+    
+    def loadNumberOfDocuments(self):
+        pass
+    
+    def loadAllDocumentCounts(self):
+        pass
+    
+    '''
+    Decodes the counts of the features from the snapshot into the feature cache
+    '''
+    def loadFeatureCountsForCategories(self, features, categoryIds=[0]):
+        for feature in features :
+            self.getFeatureCounts(feature)
+    
+    def getNumDocumentsForCategory(self, category):
+        return self.__documentCountHash.get(category.id, 0)
+    
+    def getNumberOfDocuments(self):
+        return self.__snapshot.numberOfDocuments
+    
+    def getFeatureCounts(self, featureName):
+        counts = self.__featureCache.get(featureName)
+        if counts is None :
+            counts = self.__snapshot.getFeatureCounts(featureName)
+            self.__featureCache.put(featureName, counts)
+        return counts
+    
+    def getFeatureCategoryCount(self, featureName, category):
+        return self.getFeatureCounts(featureName).get(category.id, 0)
+    
+    def getTotalFeatureCount(self, featureName, categoriesYesNo) :
+        counts = self.getFeatureCounts(featureName)
+        return counts.get(categoriesYesNo[0].id, 0) + counts.get(categoriesYesNo[1].id, 0)
+    
+    
+'''
+Classifier index holding the whole model in a few flat arrays instead of a dict per
+feature, small enough to keep every feature in memory on every worker.  Feature names
+are mapped to row numbers, the counts of row r are counts[offsets[r]:offsets[r + 1]]
+with the category of each count given as an integer column, sorted within the row.
+The index is loaded once per model version and never queries the database while
+classifying.
+'''
+class CompactClassifierIndex(ClassifierIndex):
+    
+    # Process wide compact index shared by all classifiers in this worker
+    __sharedIndex = None
+    __sharedLock = threading.Lock()
+    __refreshLock = threading.Lock()
+    __lastVersionCheck = 0
+    
+    def __init__(self):
+        super(CompactClassifierIndex, self).__init__()
+        self.__version = None
+        self.__numberOfDocuments = 0
+        self.__featureRows = {}
+        # Rows changed since the index was loaded, as {featureName : {categoryId : count}}
+        self.__changedRows = {}
+        self.__offsets = array('I', [0])
+        self.__columns = array('i')
+        self.__counts = array('i')
+        self.__categoryColumns = {}
+        self.__categoryIds = array('i')
+        self.__documentCounts = array('i')
+    
+    '''
+    Returns the shared compact index.  When training bumps the model version the logged
+    count changes are applied, the index is only reloaded when the log asks for it or
+    every CLASSIFIER_INDEX_RELOAD_INTERVAL seconds.  The version is checked at most once
+    every CLASSIFIER_INDEX_CHECK_INTERVAL seconds.  The database is read outside of the
+    shared lock, other threads keep classifying with the current index meanwhile.
+    '''
+    @staticmethod
+    def getCompactIndex():
+        with CompactClassifierIndex.__sharedLock :
+            index = CompactClassifierIndex.__sharedIndex
+            now = time.time()
+            checkInterval = getattr(settings, 'CLASSIFIER_INDEX_CHECK_INTERVAL', 1.0)
+            isDue = index is None or now - CompactClassifierIndex.__lastVersionCheck >= checkInterval
+            if isDue :
+                CompactClassifierIndex.__lastVersionCheck = now
+        
+        if isDue :
+            try :
+                version = ClassifierModelVersion.getVersion()
+            except Exception, ex :
+                raise ClassifyIndexLoadFailure("Failed to load the model version: %s" % str(ex))
+            if index is None or index.getVersion() != version or index.isStale() :
+                CompactClassifierIndex.__refreshCompactIndex(index, version)
+            with CompactClassifierIndex.__sharedLock :
+                index = CompactClassifierIndex.__sharedIndex
+        return index
+    
+    '''
+    Applies the change log to the shared index or replaces it with a new index.  Refreshes
+    run one at a time, nothing happens when the index was replaced meanwhile.
+    '''
+    @staticmethod
+    def __refreshCompactIndex(index, version):
+        with CompactClassifierIndex.__refreshLock :
+            if index is not CompactClassifierIndex.__sharedIndex :
+                return
+            
+            changes = index.readChangeLog() if index is not None else None
+            if changes is None :
+                newIndex = CompactClassifierIndex.__loadCompactIndex(version)
+                with CompactClassifierIndex.__sharedLock :
+                    CompactClassifierIndex.__sharedIndex = newIndex
+            else :
+                with CompactClassifierIndex.__sharedLock :
+                    index.applyChanges(changes)
+                    index.__version = version
+    
+    @staticmethod
+    def __loadCompactIndex(version):
+        logger = logging.getLogger("CompactClassifierIndex.getCompactIndex")
+        logger.info("loading compact classifier index for model version %s" % str(version))
+        
+        CategoryRegistry.getSharedRegistry().invalidate()
+        # A change committed while the counts are read may or may not be part of them
+        for attempt in range(LOAD_ATTEMPTS) :
+            index = CompactClassifierIndex()
+            index.__version = version
+            index.startChangeLog()
+            position = index.getChangeLogPosition()
+            index.loadAllDocumentCounts()
+            index.loadNumberOfDocuments()
+            index.loadAllFeatureCounts()
+            if index.isChangeLogAt(position) :
+                break
+        else :
+            logger.info("count changes kept being committed while loading, reloading on the next check")
+            index.setStale()
+        return index
+    
+    def getVersion(self):
+        return self.__version
+    
+    def __getColumn(self, categoryId):
+        column = self.__categoryColumns.get(categoryId)
+        if column is None :
+            column = self.__categoryColumns[categoryId] = len(self.__categoryIds)
+            self.__categoryIds.append(categoryId)
+            self.__documentCounts.append(0)
+        return column
+    
+    def loadNumberOfDocuments(self):
+        try :
+            self.__numberOfDocuments = self._getCountStore().getNumberOfDocuments()
+        except Exception, ex :
+            raise ClassifyIndexLoadFailure("Failed to load number of documents: " + str(ex))
+    
+    def loadAllDocumentCounts(self):
+        try :
+            for categoryId, count in self._getCountStore().getDocumentCounts().items() :
+                self.__documentCounts[self.__getColumn(categoryId)] = count
+        except Exception, ex :
+            raise ClassifyIndexLoadFailure("Failed to load all document counts: " + str(ex))
+    
+    '''
+    Loads the counts of every feature into the arrays
+    '''
+    def loadAllFeatureCounts(self):
+        try :
+            featureName = None
+            row = []
+            for nextFeatureName, categoryId, count in FeatureCategoryCount.getAllCounts() :
+                if nextFeatureName != featureName :
+                    self.__addRow(featureName, row)
+                    featureName = nextFeatureName
+                    row = []
+                row.append((self.__getColumn(categoryId), count))
+            self.__addRow(featureName, row)
+        except Exception, ex :
+            raise ClassifyIndexLoadFailure("Failed to load the feature counts!: %s " % str(ex))
+    
+    def __addRow(self, featureName, row):
+        if row :
+            # utf-8 strings take a quarter of the memory of unicode ones
+            self.__featureRows[encodeFeatureName(featureName)] = len(self.__offsets) - 1
+            for column, count in sorted(row) :
+                self.__columns.append(column)
+                self.__counts.append(count)
+            self.__offsets.append(len(self.__counts))
+    
+    '''
+    Everything is loaded already
+    '''
+    def loadFeatureCountsForCategories(self, features, categoryIds=[0]):
+        pass
+    
+    def getNumDocumentsForCategory(self, category):
+        column = self.__categoryColumns.get(category.id)
+        return self.__documentCounts[column] if column is not None else 0
+    
+    def getNumberOfDocuments(self):
+        return self.__numberOfDocuments
+    
+    '''
+    Changed rows are kept in dicts on top of the arrays
+    '''
+    def applyCountChanges(self, featureDeltas, categoryDeltas, documentsDelta):
+        for featureName, deltas in featureDeltas.items() :
+            self.__changedRows[encodeFeatureName(featureName)] = self._addDeltas(self.getFeatureCounts(featureName), deltas)
+        
+        for categoryId, delta in categoryDeltas.items() :
+            if categoryId not in self.__categoryColumns :
+                self._resetCategories()
+            column = self.__getColumn(categoryId)
+            self.__documentCounts[column] = max(self.__documentCounts[column] + delta, 0)
+        self.__numberOfDocuments = max(self.__numberOfDocuments + documentsDelta, 0)
+        self._revision += 1
+    
+    def getFeatureCounts(self, featureName):
+        featureName = encodeFeatureName(featureName)
+        counts = self.__changedRows.get(featureName)
+        if counts is not None :
+            return counts
+        row = self.__featureRows.get(featureName)
+        if row is None :
+            return {}
+        return dict((self.__categoryIds[self.__columns[i]], self.__counts[i]) 
+                    for i in range(self.__offsets[row], self.__offsets[row + 1]))
+    
+    def getFeatureCategoryCount(self, featureName, category):
+        featureName = encodeFeatureName(featureName)
+        counts = self.__changedRows.get(featureName)
+        if counts is not None :
+            return counts.get(category.id, 0)
+        row = self.__featureRows.get(featureName)
+        column = self.__categoryColumns.get(category.id)
+        if row is None or column is None :
+            return 0
+        end = self.__offsets[row + 1]
+        i = bisect.bisect_left(self.__columns, column, self.__offsets[row], end)
+        return self.__counts[i] if i < end and self.__columns[i] == column else 0
+    
+    def getTotalFeatureCount(self, featureName, categoriesYesNo) :
+        return self.getFeatureCategoryCount(featureName, categoriesYesNo[0]) + \
+            self.getFeatureCategoryCount(featureName, categoriesYesNo[1])
+    
+    
 class ClassifyIndexLoadFailure(Exception):
     def __init__(self, value):
         self.value = value
@@ -0,0 +1,72 @@
+'''
+Compact encoding of the {categoryId : count} maps stored in text columns.
+
+The category ids are sorted and written as deltas, each followed by its count, all as
+unsigned LEB128 varints.  The bytes are base64 encoded behind a one character marker
+so they fit the existing text columns.  A document labeled with two categories takes
+9 characters instead of the 20 or so of the JSON object it replaces.
+
+Blobs written before, JSON objects keyed by the category ids as decimal strings, are
+still decoded so rows can be migrated lazily (see classify_train --migrate_counts).
+'''
+import base64
+import json
+
+BINARY_MARKER = '~'
+
+def encodeVarints(values):
+    data = bytearray()
+    for value in values :
+        if value < 0 :
+            raise ValueError("Only non negative values can be encoded: %d" % value)
+        while value >= 0x80 :
+            data.append((value & 0x7f) | 0x80)
+            value >>= 7
+        data.append(value)
+    return str(data)
+
+def decodeVarints(data):
+    values = []
+    value = 0
+    shift = 0
+    for byte in bytearray(data) :
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80 :
+            shift += 7
+        else :
+            values.append(value)
+            value = 0
+            shift = 0
+    return values
+
+'''
+Encodes {categoryId : count} with integer category ids and non negative counts
+'''
+def encodeCounts(counts):
+    values = []
+    previousId = 0
+    for categoryId, count in sorted((int(categoryId), count) for categoryId, count in counts.items()) :
+        values.append(categoryId - previousId)
+        values.append(count)
+        previousId = categoryId
+    return BINARY_MARKER + base64.b64encode(encodeVarints(values))
+
+'''
+Decodes a binary or legacy JSON blob into {categoryId : count} with integer ids
+'''
+def decodeCounts(data):
+    if not data :
+        return {}
+    if not isBinary(data) :
+        return dict((int(categoryId), count) for categoryId, count in json.loads(data).items())
+
+    values = decodeVarints(base64.b64decode(str(data[len(BINARY_MARKER):])))
+    counts = {}
+    categoryId = 0
+    for i in range(0, len(values) - 1, 2) :
+        categoryId += values[i]
+        counts[categoryId] = values[i + 1]
+    return counts
+
+def isBinary(data):
+    return data.startswith(BINARY_MARKER)
@@ -0,0 +1,274 @@
+'''
+K-fold cross validation of the classifiers without the database.
+
+The features of every labeled document are extracted once and kept as integer ids.  The
+counts of all the documents are summed once into a MemoryCountStore, the counts a fold
+was trained without are the total minus the counts of the fold itself, so no fold is
+ever retrained.  Folds and classifiers are scored in parallel worker processes, which
+inherit the counts from the parent when they are forked.
+
+The probabilities of every tag are computed once per document, so a list of thresholds
+is evaluated for the price of one.
+
+    crossValidation = CrossValidation(folds=10)
+    for features, yesTagNames, noTagNames in labeledDocuments :
+        crossValidation.addDocument(features, yesTagNames, noTagNames)
+    results = crossValidation.evaluate({'fisher' : FisherBayesClassifier()}, thresholds=[.5, .6, .7])
+'''
+from array import array
+from classifier.classifiers import Classification, ClassifierIndex
+from classifier.stores import MemoryCountStore
+import logging
+import multiprocessing
+import random
+
+# The cross validation being evaluated, inherited by the forked worker processes
+_crossValidation = None
+
+'''
+Scores one fold with one classifier, runs in the worker processes
+'''
+def _evaluateFold(job):
+    classifierName, fold, thresholds = job
+    return classifierName, _crossValidation.evaluateFold(classifierName, fold, thresholds)
+
+
+'''
+Returns the precision, recall, f1 and accuracy of [truePositives, falsePositives,
+falseNegatives, trueNegatives]
+'''
+def getScores(confusion):
+    truePositives, falsePositives, falseNegatives, trueNegatives = confusion
+    precision = float(truePositives) / (truePositives + falsePositives) if truePositives + falsePositives else 0.0
+    recall = float(truePositives) / (truePositives + falseNegatives) if truePositives + falseNegatives else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    total = sum(confusion)
+    accuracy = float(truePositives + trueNegatives) / total if total else 0.0
+    return precision, recall, f1, accuracy
+
+'''
+Sums the confusion counts of all the tags
+'''
+def getTotalConfusion(tagConfusion):
+    total = [0, 0, 0, 0]
+    for confusion in tagConfusion.values() :
+        for i in range(4) :
+            total[i] += confusion[i]
+    return total
+
+
+'''
+Classifier index of one fold: the total counts minus the counts of the fold
+'''
+class FoldClassifierIndex(ClassifierIndex):
+
+    def __init__(self, countStore, categories, foldFeatureCounts, foldDocumentCounts, numberOfDocuments):
+        super(FoldClassifierIndex, self).__init__()
+        self.__countStore = countStore
+        self.__categories = categories
+        self.__foldFeatureCounts = foldFeatureCounts
+        self.__foldDocumentCounts = foldDocumentCounts
+        self.__numberOfDocuments = numberOfDocuments
+        self.__featureCounts = {}
+
+    def getCategories(self):
+        return self.__categories
+
+    def loadNumberOfDocuments(self):
+        pass
+
+    def loadAllDocumentCounts(self):
+        pass
+
+    def loadFeatureCountsForCategories(self, features, categoryIds=[0]):
+        pass
+
+    def getNumDocumentsForCategory(self, category):
+        return self.__countStore.getNumDocumentsForCategory(category.id) - self.__foldDocumentCounts.get(category.id, 0)
+
+    def getNumberOfDocuments(self):
+        return self.__numberOfDocuments
+
+    '''
+    The features of the fold are subtracted the first time they are looked up
+    '''
+    def getFeatureCounts(self, featureName):
+        counts = self.__featureCounts.get(featureName)
+        if counts is None :
+            counts = self.__countStore.getFeatureCounts(featureName)
+            foldCounts = self.__foldFeatureCounts.get(featureName)
+            if foldCounts :
+                counts = dict((categoryId, count - foldCounts.get(categoryId, 0)) for categoryId, count in counts.items()
+                              if count > foldCounts.get(categoryId, 0))
+            self.__featureCounts[featureName] = counts
+        return counts
+
+    def getFeatureCategoryCount(self, featureName, category):
+        return self.getFeatureCounts(featureName).get(category.id, 0)
+
+    def getTotalFeatureCount(self, featureName, categoriesYesNo) :
+        counts = self.getFeatureCounts(featureName)
+        return counts.get(categoriesYesNo[0].id, 0) + counts.get(categoriesYesNo[1].id, 0)
+
+
+'''
+Labeled documents split into folds, see the module documentation
+'''
+class CrossValidation(object):
+
+    def __init__(self, folds=10, seed=0):
+        if folds < 2 :
+            raise ValueError("Cross validation needs at least 2 folds: %d" % folds)
+        self.__numFolds = folds
+        self.__random = random.Random(seed)
+        self.__countStore = MemoryCountStore()
+        self.__featureIds = {}
+        # Per document: feature ids, category ids and fold
+        self.__documentFeatures = []
+        self.__documentCategories = []
+        self.__documentFolds = array('H')
+        self.__foldSizes = [0] * folds
+        self.__round = []
+        self.__pendingFeatureCounts = {}
+        self.__pendingDocumentCounts = {}
+
+    def getNumberOfDocuments(self):
+        return len(self.__documentFeatures)
+
+    '''
+    Adds a labeled document with its extracted features.  Documents are dealt to the
+    folds at random, keeping the folds the same size.
+    '''
+    def addDocument(self, features, yesTagNames=None, noTagNames=None):
+        yesTagNames = [tagName for tagName in yesTagNames or [] if tagName]
+        noTagNames = [tagName for tagName in noTagNames or [] if tagName]
+        categoryPairs = self.__countStore.getCategoryPairs(yesTagNames + noTagNames)
+        categoryIds = set(categoryPairs[tagName][0].id for tagName in yesTagNames)
+        categoryIds.update(categoryPairs[tagName][1].id for tagName in noTagNames)
+
+        featureIds = array('i')
+        for feature in features :
+            featureId = self.__featureIds.get(feature)
+            if featureId is None :
+                featureId = self.__featureIds[feature] = len(self.__featureIds)
+            featureIds.append(featureId)
+
+        index = len(self.__documentFeatures)
+        fold = index % self.__numFolds
+        if fold == 0 :
+            # Start of a round, deal one document to every fold in random order
+            self.__round = range(self.__numFolds)
+            self.__random.shuffle(self.__round)
+        fold = self.__round[fold]
+
+        self.__documentFeatures.append(featureIds)
+        self.__documentCategories.append(tuple(categoryIds))
+        self.__documentFolds.append(fold)
+        self.__foldSizes[fold] += 1
+        self.__addCounts(self.__pendingFeatureCounts, self.__pendingDocumentCounts, featureIds, categoryIds)
+
+    def __addCounts(self, featureCounts, documentCounts, featureIds, categoryIds):
+        for featureId in set(featureIds) :
+            counts = featureCounts.setdefault(featureId, {})
+            for categoryId in categoryIds :
+                counts[categoryId] = counts.get(categoryId, 0) + 1
+        for categoryId in categoryIds :
+            documentCounts[categoryId] = documentCounts.get(categoryId, 0) + 1
+
+    '''
+    Moves the counts of the added documents into the store
+    '''
+    def __flushCounts(self):
+        if self.__pendingDocumentCounts or self.__pendingFeatureCounts :
+            self.__countStore.addCounts(self.__pendingFeatureCounts, self.__pendingDocumentCounts, 0)
+            self.__pendingFeatureCounts = {}
+            self.__pendingDocumentCounts = {}
+
+    '''
+    Scores every fold with every classifier and returns
+    {classifierName : {threshold : {tagName : [truePositives, falsePositives, falseNegatives, trueNegatives]}}}.
+    classifiers is {classifierName : classifier}.  Each threshold is applied as the yes
+    and no minimum of every tag, None stands for the thresholds set on the classifier
+    with setMinThreshold.  Only the tags a document is labeled with count for it.
+    '''
+    def evaluate(self, classifiers, thresholds=None, workers=1):
+        global _crossValidation
+        logger = logging.getLogger("CrossValidation.evaluate")
+
+        self.__flushCounts()
+        self.__classifiers = classifiers
+        thresholds = list(thresholds or [None])
+        jobs = [(classifierName, fold, thresholds) for fold in range(self.__numFolds) for classifierName in classifiers]
+
+        results = dict((classifierName, dict((threshold, {}) for threshold in thresholds)) for classifierName in classifiers)
+        _crossValidation = self
+        try :
+            if workers <= 1 :
+                foldResults = map(_evaluateFold, jobs)
+            else :
+                pool = multiprocessing.Pool(workers)
+                try :
+                    foldResults = pool.map(_evaluateFold, jobs, chunksize=1)
+                    pool.close()
+                except :
+                    pool.terminate()
+                    raise
+                finally :
+                    pool.join()
+        finally :
+            _crossValidation = None
+
+        for classifierName, thresholdConfusion in foldResults :
+            for threshold, tagConfusion in thresholdConfusion.items() :
+                totals = results[classifierName][threshold]
+                for tagName, confusion in tagConfusion.items() :
+                    total = totals.setdefault(tagName, [0, 0, 0, 0])
+                    for i in range(4) :
+                        total[i] += confusion[i]
+
+        logger.info("Evaluated %d documents in %d folds" % (len(self.__documentFeatures), self.__numFolds))
+        return results
+
+    '''
+    Scores the documents of a fold against the counts of all the other folds.
+    Returns {threshold : {tagName : confusion}}.
+    '''
+    def evaluateFold(self, classifierName, fold, thresholds):
+        classifier = self.__classifiers[classifierName]
+
+        foldFeatureCounts = {}
+        foldDocumentCounts = {}
+        for featureIds, categoryIds, documentFold in zip(self.__documentFeatures, self.__documentCategories, self.__documentFolds) :
+            if documentFold == fold :
+                self.__addCounts(foldFeatureCounts, foldDocumentCounts, featureIds, categoryIds)
+
+        categories = sorted(self.__countStore.getAllCategories(), key=lambda category: category.id)
+        index = FoldClassifierIndex(self.__countStore, categories, foldFeatureCounts, foldDocumentCounts,
+                                    len(self.__documentFeatures) - self.__foldSizes[fold])
+        groupedCategories = index.getGroupedCategories()
+
+        results = dict((threshold, {}) for threshold in thresholds)
+        for featureIds, categoryIds, documentFold in zip(self.__documentFeatures, self.__documentCategories, self.__documentFolds) :
+            if documentFold != fold :
+                continue
+            classification = Classification("", list(featureIds), index)
+            for tagName, yesProb, noProb in classifier._getTagProbs(classification, groupedCategories) :
+                if groupedCategories[tagName][True].id in categoryIds :
+                    isYes = True
+                elif groupedCategories[tagName][False].id in categoryIds :
+                    isYes = False
+                else :
+                    continue
+
+                for threshold in thresholds :
+                    if threshold is None :
+                        yesMin, noMin = classifier.getMinThreshold(tagName, True), classifier.getMinThreshold(tagName, False)
+                    else :
+                        yesMin = noMin = threshold
+                    predictedYes = classifier._isYesNo(yesProb, noProb, yesMin, noMin)
+                    confusion = results[threshold].setdefault(tagName, [0, 0, 0, 0])
+                    if predictedYes :
+                        confusion[0 if isYes else 1] += 1
+                    else :
+                        confusion[2 if isYes else 3] += 1
+        return results
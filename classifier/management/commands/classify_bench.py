@@ -0,0 +1,199 @@
+'''
+Benchmarks training throughput and classification latency on a synthetic corpus.
+'''
+from classifier.classifiers import BayesianClassifier, FisherBayesClassifier
+from classifier.trainer import Trainer
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, reset_queries
+from optparse import make_option
+import os
+import random
+import resource
+import string
+import subprocess
+import sys
+import threading
+import time
+
+# Runs in a fresh interpreter, measures importing the app and the first feature extraction
+_STARTUP_SCRIPT = '''
+import resource, time
+start = time.time()
+import classifier.classifiers, classifier.trainer
+imported = time.time()
+importMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+from classifier import FeatureExtractor
+FeatureExtractor().getFeatures("measuring the first feature extraction")
+print "%f %d %f %d" % (imported - start, importMemory, time.time() - imported, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+def _getPercentile(values, percentile):
+    values = sorted(values)
+    if not values :
+        return 0.0
+    return values[int(round((len(values) - 1) * percentile / 100.0))]
+
+def _getPeakMemory():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Command(BaseCommand):
+    help = "Benchmarks training throughput and classification latency on a synthetic corpus. " \
+           "The benchmark runs against a throw away test database, in memory when the database is SQLite."
+    __doc__ = help
+
+    option_list = BaseCommand.option_list + (
+        make_option('--documents', dest='documents', type='int',
+                    default=1000, help='Number of labeled documents to train'),
+        make_option('--classify_documents', dest='classify_documents', type='int',
+                    default=200, help='Number of documents to classify per classifier'),
+        make_option('--vocabulary', dest='vocabulary', type='int',
+                    default=5000, help='Number of distinct words'),
+        make_option('--categories', dest='categories', type='int',
+                    default=10, help='Number of categories'),
+        make_option('--words', dest='words', type='int',
+                    default=60, help='Number of words per document'),
+        make_option('--seed', dest='seed', type='int',
+                    default=1, help='Random seed of the synthetic corpus'),
+        make_option('--threads', dest='threads', type='int',
+                    default=8, help='Number of threads sharing one classifier'),
+    )
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        vocabulary = self.__getVocabulary(options['vocabulary'])
+        categories = ["category%d" % i for i in range(options['categories'])]
+        topics = dict((category, random.sample(vocabulary, max(len(vocabulary) // 20, 1))) for category in categories)
+
+        documents = [self.__getDocument(vocabulary, categories, topics, options['words']) for _ in range(options['documents'])]
+        classifyDocuments = [self.__getDocument(vocabulary, categories, topics, options['words'])[0]
+                             for _ in range(options['classify_documents'])]
+
+        self.__benchStartup()
+        print "Corpus: %d documents, %d words, %d categories" % (len(documents), len(vocabulary), len(categories))
+
+        oldDatabaseName = connection.creation.create_test_db(verbosity=0)
+        oldDebug = settings.DEBUG
+        # Queries are only recorded in debug mode
+        settings.DEBUG = True
+        try :
+            half = len(documents) // 2
+            self.__benchTrain(documents[:half])
+            self.__benchTrainMany(documents[half:])
+            for classifierClass in (BayesianClassifier, FisherBayesClassifier) :
+                self.__benchClassify(classifierClass, classifyDocuments)
+                self.__benchThreads(classifierClass, classifyDocuments, options['threads'])
+        finally :
+            settings.DEBUG = oldDebug
+            connection.creation.destroy_test_db(oldDatabaseName, verbosity=0)
+
+    '''
+    Cold start of a process that loads the app, and the extra cost of the first
+    feature extraction which loads NLTK
+    '''
+    def __benchStartup(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+        process = subprocess.Popen([sys.executable, '-c', _STARTUP_SCRIPT], stdout=subprocess.PIPE, 
+                                   stderr=subprocess.PIPE, env=env)
+        output, errors = process.communicate()
+        if process.returncode != 0 :
+            print "Startup: failed to measure: %s" % errors.strip().splitlines()[-1:]
+            return
+        importTime, importMemory, extractTime, extractMemory = output.split()
+        print "Startup: import %.1f ms, peak memory %s KB, first extraction %.1f ms, peak memory %s KB" % (
+            float(importTime) * 1000.0, importMemory, float(extractTime) * 1000.0, extractMemory)
+
+    def __getVocabulary(self, size):
+        vocabulary = set()
+        while len(vocabulary) < size :
+            vocabulary.add(''.join(random.choice(string.ascii_lowercase) for _ in range(random.randint(4, 10))))
+        return list(vocabulary)
+
+    '''
+    A document is drawn half from the topic words of its yes category and half from the
+    whole vocabulary, it is labeled yes for one category and no for another one.
+    '''
+    def __getDocument(self, vocabulary, categories, topics, numWords):
+        yesCategory, noCategory = random.sample(categories, 2) if len(categories) > 1 else (categories[0], "")
+        words = [random.choice(topics[yesCategory]) if i % 2 else random.choice(vocabulary) for i in range(numWords)]
+        return " ".join(words), [yesCategory], [noCategory]
+
+    def __benchTrain(self, documents):
+        trainer = Trainer()
+        queries = 0
+        start = time.time()
+        for corpus, yesTagNames, noTagNames in documents :
+            reset_queries()
+            trainer.train(corpus, yesTagNames, noTagNames)
+            queries += len(connection.queries)
+        elapsed = max(time.time() - start, 0.000001)
+
+        print "Trainer.train:      %8.1f docs/sec, %6.1f queries/doc, peak memory %d KB" % (
+            len(documents) / elapsed, queries / float(max(len(documents), 1)), _getPeakMemory())
+
+    def __benchTrainMany(self, documents):
+        trainer = Trainer()
+        reset_queries()
+        start = time.time()
+        trainer.trainMany(documents)
+        elapsed = max(time.time() - start, 0.000001)
+
+        print "Trainer.trainMany:  %8.1f docs/sec, %6.1f queries/doc, peak memory %d KB" % (
+            len(documents) / elapsed, len(connection.queries) / float(max(len(documents), 1)), _getPeakMemory())
+
+    def __benchClassify(self, classifierClass, documents):
+        classifier = classifierClass()
+        # Warm up the shared index so the latencies are the steady state ones
+        if documents :
+            classifier.classify(documents[0])
+
+        latencies = []
+        queries = 0
+        for corpus in documents :
+            reset_queries()
+            start = time.time()
+            classifier.classify(corpus)
+            latencies.append((time.time() - start) * 1000.0)
+            queries += len(connection.queries)
+
+        print "%s.classify: p50 %.2f ms, p95 %.2f ms, p99 %.2f ms, %.1f queries/doc, peak memory %d KB" % (
+            classifierClass.__name__, _getPercentile(latencies, 50), _getPercentile(latencies, 95),
+            _getPercentile(latencies, 99), queries / float(max(len(documents), 1)), _getPeakMemory())
+
+    '''
+    Classifies the documents from many threads with a single shared classifier, the
+    results are checked by the tests.  The in memory test database isn't visible from 
+    other threads, so the shared index is warmed with all the features first and its
+    version checks are paused while the threads run.
+    '''
+    def __benchThreads(self, classifierClass, documents, numThreads):
+        classifier = classifierClass()
+        for corpus in documents :
+            classifier.classify(corpus)
+        errors = []
+
+        def classifyAll():
+            try :
+                for corpus in documents :
+                    classifier.classify(corpus)
+            except Exception, ex :
+                errors.append(ex)
+
+        oldCheckInterval = getattr(settings, 'CLASSIFIER_INDEX_CHECK_INTERVAL', 1.0)
+        settings.CLASSIFIER_INDEX_CHECK_INTERVAL = float('inf')
+        try :
+            threads = [threading.Thread(target=classifyAll) for _ in range(numThreads)]
+            start = time.time()
+            for thread in threads :
+                thread.start()
+            for thread in threads :
+                thread.join()
+            elapsed = max(time.time() - start, 0.000001)
+        finally :
+            settings.CLASSIFIER_INDEX_CHECK_INTERVAL = oldCheckInterval
+
+        print "%s.classify x %d threads: %8.1f docs/sec, %d errors" % (
+            classifierClass.__name__, numThreads, len(documents) * numThreads / elapsed, len(errors))
@@ -0,0 +1,116 @@
+'''
+Cross validates the classifiers on labeled files without the database.
+'''
+from classifier import FeatureExtractor
+from classifier.classifiers import BayesianClassifier, FisherBayesClassifier
+from classifier.evaluation import CrossValidation, getScores, getTotalConfusion
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import multiprocessing
+import os
+import time
+
+CLASSIFIERS = {
+    'bayes' : BayesianClassifier,
+    'fisher' : FisherBayesClassifier,
+}
+
+'''
+Reads a labeled file and extracts its features, runs in the worker processes.
+Lines of the labels file are: path<tab>yes tags<tab>no tags, tags comma separated.
+'''
+def _extractLabeledFile(job):
+    directory, line = job
+    fields = line.rstrip("\r\n").split("\t")
+    filePath = os.path.join(directory, fields[0])
+    yesTagNames = fields[1].split(",") if len(fields) > 1 else []
+    noTagNames = fields[2].split(",") if len(fields) > 2 else []
+
+    corpusFile = open(filePath, 'rb')
+    try :
+        corpus = corpusFile.read()
+    finally :
+        corpusFile.close()
+    return FeatureExtractor.getSharedExtractor().getFeatures(corpus), yesTagNames, noTagNames
+
+
+class Command(BaseCommand):
+    help = "Cross validates the classifiers on labeled files, the features are extracted once and " \
+           "the folds are scored in parallel without touching the database"
+    __doc__ = help
+
+    option_list = BaseCommand.option_list + (
+        make_option('--labels', dest='labels',
+                    default='', help='Labels file, lines of path<tab>yes tags<tab>no tags relative to the file'),
+        make_option('--folds', dest='folds', type='int',
+                    default=10, help='Number of folds'),
+        make_option('--classifiers', dest='classifiers',
+                    default='bayes,fisher', help='Classifiers to evaluate: bayes, fisher'),
+        make_option('--thresholds', dest='thresholds',
+                    default='', help='Comma separated minimum probabilities to evaluate, defaults to the classifier thresholds'),
+        make_option('--workers', dest='workers', type='int',
+                    default=multiprocessing.cpu_count(), help='Number of processes extracting features and scoring folds'),
+        make_option('--seed', dest='seed', type='int',
+                    default=0, help='Random seed of the fold assignment'),
+        make_option('--per_tag', dest='per_tag', action='store_true',
+                    default=False, help='Also prints the scores of every tag'),
+    )
+
+    def handle(self, *args, **options):
+        if not options['labels'] :
+            raise CommandError("No labeled documents, pass --labels")
+        classifierNames = [name.strip() for name in options['classifiers'].split(",") if name.strip()]
+        for name in classifierNames :
+            if name not in CLASSIFIERS :
+                raise CommandError("Unknown classifier %s, use one of %s" % (name, ", ".join(sorted(CLASSIFIERS))))
+        thresholds = [float(threshold) for threshold in options['thresholds'].split(",") if threshold.strip()] or None
+
+        crossValidation = CrossValidation(folds=options['folds'], seed=options['seed'])
+        start = time.time()
+        for features, yesTagNames, noTagNames in self.__extractLabels(options['labels'], options['workers']) :
+            crossValidation.addDocument(features, yesTagNames, noTagNames)
+        print "Extracted the features of %d documents in %.1fs" % (crossValidation.getNumberOfDocuments(), time.time() - start)
+
+        start = time.time()
+        classifiers = dict((name, CLASSIFIERS[name]()) for name in classifierNames)
+        results = crossValidation.evaluate(classifiers, thresholds=thresholds, workers=options['workers'])
+        print "Scored %d folds in %.1fs" % (options['folds'], time.time() - start)
+
+        print "%-10s %-10s %10s %10s %10s %10s" % ("classifier", "threshold", "precision", "recall", "f1", "accuracy")
+        for name in classifierNames :
+            for threshold in thresholds or [None] :
+                tagConfusion = results[name][threshold]
+                self.__printScores(name, threshold, getTotalConfusion(tagConfusion))
+                if options['per_tag'] :
+                    for tagName, confusion in sorted(tagConfusion.items()) :
+                        self.__printScores("  " + tagName, threshold, confusion)
+
+    def __printScores(self, name, threshold, confusion):
+        threshold = "default" if threshold is None else "%.3f" % threshold
+        print "%-10s %-10s %10.4f %10.4f %10.4f %10.4f" % ((name, threshold) + getScores(confusion))
+
+    '''
+    Yields (features, yesTagNames, noTagNames) for every line of the labels file
+    '''
+    def __extractLabels(self, labelsPath, workers):
+        directory = os.path.dirname(os.path.abspath(labelsPath))
+        labelsFile = open(labelsPath, 'rb')
+        try :
+            jobs = ((directory, line) for line in labelsFile if line.strip())
+            if workers <= 1 :
+                for job in jobs :
+                    yield _extractLabeledFile(job)
+                return
+
+            pool = multiprocessing.Pool(workers)
+            try :
+                for result in pool.imap(_extractLabeledFile, jobs, chunksize=64) :
+                    yield result
+                pool.close()
+            except :
+                pool.terminate()
+                raise
+            finally :
+                pool.join()
+        finally :
+            labelsFile.close()
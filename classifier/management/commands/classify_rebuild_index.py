@@ -0,0 +1,114 @@
+'''
+Recomputes the feature/category and category document counts from the trained documents.
+'''
+from classifier import FeatureExtractor
+from classifier.models import Document, DocumentCategoryCounts, FeatureCategoryCount, \
+    CategoryDocumentCount, ClassifierModelVersion, CountChangeLog
+from django.core.management.base import BaseCommand
+from django.db import transaction, connection
+from django.db.models import Min, Max
+from optparse import make_option
+import multiprocessing
+import sys
+import time
+
+'''
+Counts the documents with ids in [startId, endId), runs in the worker processes.
+Returns ({featureName : {categoryId : count}}, {categoryId : count}, number of documents)
+'''
+def _countDocuments(idRange):
+    startId, endId = idRange
+    featureCounts = {}
+    documentCounts = {}
+    numDocuments = 0
+    
+    rows = DocumentCategoryCounts.objects.filter(document__id__gte=startId, document__id__lt=endId).only('document', 'countData', 'featureData')
+    for row in rows.iterator() :
+        categoryIds = [categoryId for categoryId, count in row.getCounts().items() if count > 0]
+        features = row.getFeatures()
+        if features is None :
+            features = FeatureExtractor.getSharedExtractor().getFeatures(row.document.corpus)
+        
+        for categoryId in categoryIds :
+            documentCounts[categoryId] = documentCounts.get(categoryId, 0) + 1
+        for feature in features :
+            counts = featureCounts.setdefault(feature, {})
+            for categoryId in categoryIds :
+                counts[categoryId] = counts.get(categoryId, 0) + 1
+        numDocuments += 1
+        
+    return featureCounts, documentCounts, numDocuments
+
+def _mergeCounts(counts, moreCounts):
+    for key, count in moreCounts.items() :
+        counts[key] = counts.get(key, 0) + count
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the feature and category document counts from the trained documents. " \
+           "Stop training while the index is rebuilt, updates made in the meantime are lost."
+    __doc__ = help
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', type='int',
+                    default=1, help='Number of processes counting documents'),
+        make_option('--chunk_size', dest='chunk_size', type='int',
+                    default=1000, help='Number of document ids read at once'),
+    )
+    
+    def handle(self, *args, **options):
+        idRanges = self.__getIdRanges(options['chunk_size'])
+        
+        start = time.time()
+        featureCounts = {}
+        documentCounts = {}
+        numDocuments = 0
+        for chunkFeatureCounts, chunkDocumentCounts, chunkDocuments in self.__countChunks(idRanges, options['workers']) :
+            for featureName, counts in chunkFeatureCounts.items() :
+                _mergeCounts(featureCounts.setdefault(featureName, {}), counts)
+            _mergeCounts(documentCounts, chunkDocumentCounts)
+            numDocuments += chunkDocuments
+            sys.stderr.write("\rCounted %d documents, %.1f docs/sec" % (numDocuments, numDocuments / max(time.time() - start, 0.001)))
+            sys.stderr.flush()
+        sys.stderr.write("\n")
+        
+        self.__swapCounts(featureCounts, documentCounts)
+        print "Rebuilt the index from %d documents, %d features" % (numDocuments, len(featureCounts))
+    
+    '''
+    Splits the document ids into ranges of chunkSize ids
+    '''
+    def __getIdRanges(self, chunkSize):
+        ids = Document.objects.aggregate(Min('id'), Max('id'))
+        if ids['id__min'] is None :
+            return []
+        return [(startId, startId + chunkSize) for startId in range(ids['id__min'], ids['id__max'] + 1, chunkSize)]
+    
+    def __countChunks(self, idRanges, workers):
+        if workers <= 1 :
+            for idRange in idRanges :
+                yield _countDocuments(idRange)
+            return
+        
+        # Each worker opens its own database connection
+        connection.close()
+        pool = multiprocessing.Pool(workers)
+        try :
+            for counts in pool.imap_unordered(_countDocuments, idRanges) :
+                yield counts
+            pool.close()
+        except :
+            pool.terminate()
+            raise
+        finally :
+            pool.join()
+    
+    '''
+    Swaps in the new counts in one transaction, classifiers see the old counts until it commits
+    '''
+    @transaction.commit_on_success
+    def __swapCounts(self, featureCounts, documentCounts):
+        FeatureCategoryCount.replaceAllCounts(featureCounts)
+        CategoryDocumentCount.setDocumentCounts(documentCounts)
+        CountChangeLog.recordReload()
+        ClassifierModelVersion.bumpVersion()
@@ -0,0 +1,23 @@
+'''
+Compiles the trained model into a read only snapshot file for the classifiers.
+'''
+from classifier.snapshot import compileSnapshot
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+class Command(BaseCommand):
+    help = "Compiles the trained model into a snapshot file that classifiers mmap"
+    __doc__ = help
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output',
+                    default='', help='Snapshot file, defaults to CLASSIFIER_SNAPSHOT_PATH'),
+    )
+    
+    def handle(self, *args, **options):
+        path = options['output'] or getattr(settings, 'CLASSIFIER_SNAPSHOT_PATH', None)
+        if not path :
+            raise CommandError("No snapshot path, pass --output or set CLASSIFIER_SNAPSHOT_PATH")
+        
+        version = compileSnapshot(path)
+        print "Compiled model version %d into %s" % (version, path)
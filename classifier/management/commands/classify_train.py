@@ -3,11 +3,58 @@ Created on Feb 10, 2012
 
 @author: Dannie
 '''
+from classifier import FeatureExtractor
 from classifier.classifiers import Classifier, FisherBayesClassifier
+from classifier.models import FeatureCategoryCount, CategoryDocumentCount, DocumentCategoryCounts, \
+    ClassifierModelVersion, CountChangeLog, Document
 from classifier.trainer import Trainer
 from django.core.management.base import BaseCommand
+from django.db import transaction, connection
 from optparse import make_option
+import multiprocessing
 import os
+import sys
+import time
+
+'''
+Reads a file and extracts its features, runs in the worker processes
+'''
+def _extractFile(filePath):
+    corpusFile = open(filePath, 'rb')
+    try :
+        corpus = corpusFile.read()
+    finally :
+        corpusFile.close()
+    return filePath, corpus, FeatureExtractor.getSharedExtractor().getFeatures(corpus)
+
+
+'''
+Reports the progress of long running directory jobs
+'''
+class Progress(object):
+    
+    def __init__(self, action, interval=1.0):
+        self.__action = action
+        self.__interval = interval
+        self.__count = 0
+        self.__start = self.__lastReport = time.time()
+        
+    def increment(self, count=1):
+        self.__count += count
+        now = time.time()
+        if now - self.__lastReport >= self.__interval :
+            self.__lastReport = now
+            self.__report(now, "\r")
+            
+    def finish(self):
+        self.__report(time.time(), "\n")
+            
+    def __report(self, now, end):
+        elapsed = max(now - self.__start, 0.001)
+        sys.stderr.write("%s %d documents, %.1f docs/sec%s" % (self.__action, self.__count, self.__count / elapsed, end))
+        sys.stderr.flush()
+    
+    
 class Command(BaseCommand):
     help = "Classify/Train Utilities"
     __doc__ = help
@@ -17,17 +64,31 @@ class Command(BaseCommand):
                     default=False, help='Trains a corpus'),
         make_option('--untrain_corpus', dest='untrain_corpus',
                     default=False, help='Untrains a corpus'),
+        make_option('--untrain_id', dest='untrain_id', type='int',
+                    default=None, help='Untrains a trained document by its id'),
+        make_option('--untrain_hash', dest='untrain_hash',
+                    default='', help='Untrains a trained document by its corpus hash'),
+        make_option('--relabel_id', dest='relabel_id', type='int',
+                    default=None, help='Relabels a trained document with --yes_train/--no_train'),
                                              
                                              
         make_option('--classify', dest='classify',
                     default='', help='Classifies a text corpus'),
                                              
         make_option('--directory', dest='directory',
-                    default='', help='Generic directory input'),
+                    default='', help='Trains (with --yes_train/--no_train) or classifies every file in a directory'),
+        make_option('--workers', dest='workers', type='int',
+                    default=1, help='Number of processes extracting features for --directory'),
+        make_option('--batch_size', dest='batch_size', type='int',
+                    default=500, help='Number of documents written or classified at once for --directory'),
         make_option('--yes_train', dest='yes_train',
                     default='', help='Yes train'),
         make_option('--no_train', dest='no_train',
                     default='', help='No train'),
+        make_option('--migrate_counts', dest='migrate_counts', action='store_true',
+                    default=False, help='Moves legacy JSON feature and document counts into the count tables'),
+        make_option('--prune_change_log', dest='prune_change_log', type='int',
+                    default=None, help='Deletes all but the given number of the latest count changes'),
     )
     
     __verbose = False
@@ -50,8 +111,20 @@ class Command(BaseCommand):
             self.__trainCorpus(options['train_corpus'], yesTrain.split(","), noTrain.split(","))
         elif options['untrain_corpus'] :
             self.__untrainCorpus(options['untrain_corpus'])
+        elif options['relabel_id'] is not None :
+            self.__relabelDocument(options['relabel_id'], yesTrain.split(","), noTrain.split(","))
+        elif options['untrain_id'] is not None or options['untrain_hash'] :
+            self.__untrainDocument(options['untrain_id'], options['untrain_hash'])
+        elif directory and (yesTrain or noTrain) :
+            self.__trainDirectory(directory, yesTrain.split(","), noTrain.split(","), options['workers'], options['batch_size'])
+        elif directory :
+            self.__classifyDirectory(directory, options['workers'], options['batch_size'])
         elif options['classify'] :
-            self.__classify(options['classify'], directory)
+            self.__classify(options['classify'])
+        elif options['migrate_counts'] :
+            self.__migrateCounts()
+        elif options['prune_change_log'] is not None :
+            self.__pruneChangeLog(options['prune_change_log'])
             
             
     '''
@@ -79,15 +152,122 @@ class Command(BaseCommand):
                 print "Untrained corpus: %s" % corpus[:50]
             
     
+    '''
+    Untrains a trained document by id or corpus hash
+    '''
+    def __untrainDocument(self, documentId, corpusHash):
+        trainer = Trainer()
+        success = trainer.untrain(documentId=documentId, corpusHash=corpusHash)
+        document = documentId if documentId is not None else corpusHash
+        if not success :
+            print "Failed to untrain document: %s" % document
+        else :
+            print "Untrained document: %s" % document
+            
+    '''
+    Relabels a trained document
+    '''
+    def __relabelDocument(self, documentId, yesTagNames, noTagNames):
+        if not Document.objects.filter(id=documentId).exists() :
+            print "Document doesn't exist: %d" % documentId
+            return
+        trainer = Trainer()
+        if not trainer.relabel(documentId, yesTagNames, noTagNames) :
+            print "Failed to relabel document: %d" % documentId
+        else :
+            print "Relabeled document: %d" % documentId
+            
+    '''
+    Moves the legacy JSON feature and document counts into the count tables
+    '''
+    @transaction.commit_on_success
+    def __migrateCounts(self):
+        migrated = FeatureCategoryCount.importLegacyCounts()
+        migratedCategories = CategoryDocumentCount.importLegacyCounts()
+        migratedDocuments = DocumentCategoryCounts.reencodeLegacyCounts()
+        CountChangeLog.recordReload()
+        ClassifierModelVersion.bumpVersion()
+        print "Migrated counts for %d features, %d categories and %d documents" % (migrated, migratedCategories, migratedDocuments)
+    
+    '''
+    Deletes the older count changes, warm indexes that still needed them reload
+    '''
+    @transaction.commit_on_success
+    def __pruneChangeLog(self, keep):
+        CountChangeLog.prune(CountChangeLog.getLastSequence() - max(keep, 0))
+        print "Pruned the count change log, kept the latest %d changes" % keep
+    
     def __getNextFileInDir(self, directory):
         if directory :
             files = os.listdir(directory) 
             for file in files :
                 filePath = os.path.join(directory, file) 
-                yield filePath
+                if os.path.isfile(filePath) :
+                    yield filePath
+    
+    '''
+    Yields (filePath, corpus, features) for every file in the directory, the features
+    are extracted by a pool of worker processes when workers > 1
+    '''
+    def __extractDirectory(self, directory, workers):
+        filePaths = self.__getNextFileInDir(directory)
+        if workers <= 1 :
+            for filePath in filePaths :
+                yield _extractFile(filePath)
+            return
+        
+        # Don't share the database connection with the forked workers
+        connection.close()
+        pool = multiprocessing.Pool(workers)
+        try :
+            for result in pool.imap(_extractFile, filePaths, chunksize=16) :
+                yield result
+            pool.close()
+        except :
+            pool.terminate()
+            raise
+        finally :
+            pool.join()
+    
+    '''
+    Trains every file in the directory, this process is the single writer 
+    applying the extracted features in batches
+    '''
+    def __trainDirectory(self, directory, yesTagNames, noTagNames, workers, batchSize):
+        trainer = Trainer()
+        progress = Progress("Trained")
+        
+        documents = ((corpus, yesTagNames, noTagNames, features) 
+                     for filePath, corpus, features in self.__extractDirectory(directory, workers))
+        numTrained = trainer.trainMany(documents, batchSize=batchSize, onBatch=progress.increment)
+        progress.finish()
+        print "Trained %d new documents from %s" % (numTrained, directory)
+    
+    '''
+    Classifies every file in the directory and prints the tags found for each
+    '''
+    def __classifyDirectory(self, directory, workers, batchSize):
+        classifier = FisherBayesClassifier()
+        progress = Progress("Classified")
+        
+        batch = []
+        for extracted in self.__extractDirectory(directory, workers) :
+            batch.append(extracted)
+            if len(batch) >= batchSize :
+                self.__classifyBatch(classifier, batch, progress)
+                batch = []
+        if batch :
+            self.__classifyBatch(classifier, batch, progress)
+        progress.finish()
+        
+    def __classifyBatch(self, classifier, batch, progress):
+        results = classifier.classifyMany([corpus for _, corpus, _ in batch], [features for _, _, features in batch])
+        for (filePath, _, _), tags in zip(batch, results) :
+            progress.increment()
+            print "%s: %s" % (filePath, ", ".join(tagName for tagName, yes in tags if yes))
         
     
-    def __classify(self, corpus, directory):
+    def __classify(self, corpus):
         classifier = FisherBayesClassifier()
      
         tags = classifier.classify(corpus)
@@ -4,10 +4,17 @@ Created on Feb 10, 2012
 @author: Dannie
 '''
 
-from django.db import models
+from classifier.encoding import encodeCounts, decodeCounts
+from django.conf import settings
+from django.db import models, transaction, connection, IntegrityError
+from django.db.models import F, Max, Sum
+from django.db.models.signals import post_save, post_delete
 from json.decoder import JSONDecoder
+from json.encoder import JSONEncoder
 import hashlib
 import logging
+import random
+import threading
 
 class ClassifierCategory(models.Model):
     categoryName = models.CharField(max_length=50)
@@ -58,6 +65,122 @@ class ClassifierCategory(models.Model):
             logger.exception("Failed to retrieve all the categories")
         return categories
     
+'''
+Process wide registry of the categories, so resolving tag names to their yes/no 
+category pair and ids to categories doesn't query the database once loaded.
+All the categories are loaded with one query, missing ones are bulk created.
+The registry is cleared when a category is saved or deleted in this process and
+when the model version changes (see ClassifierIndex.getSharedIndex).
+'''
+class CategoryRegistry(object):
+    
+    __sharedRegistry = None
+    __sharedLock = threading.Lock()
+    
+    def __init__(self):
+        self.__lock = threading.RLock()
+        self.__categoriesByName = None
+        self.__categoriesById = None
+        self.__creating = False
+    
+    @staticmethod
+    def getSharedRegistry():
+        if CategoryRegistry.__sharedRegistry is None :
+            with CategoryRegistry.__sharedLock :
+                if CategoryRegistry.__sharedRegistry is None :
+                    CategoryRegistry.__sharedRegistry = CategoryRegistry()
+        return CategoryRegistry.__sharedRegistry
+    
+    '''
+    Forgets all the categories, the next lookup reloads them.  The categories the
+    registry saves itself fire the signals too, they are added once created instead.
+    '''
+    def invalidate(self):
+        with self.__lock :
+            if self.__creating :
+                return
+            self.__categoriesByName = None
+            self.__categoriesById = None
+    
+    def __load(self):
+        if self.__categoriesById is None :
+            self.__categoriesByName = {}
+            self.__categoriesById = {}
+            self.__add(ClassifierCategory.objects.all())
+    
+    def __add(self, categories):
+        for category in categories :
+            self.__categoriesByName.setdefault(category.categoryName, {})[category.yes] = category
+            self.__categoriesById[category.id] = category
+    
+    def __isComplete(self, tagName):
+        categoryYesNo = self.__categoriesByName.get(tagName, {})
+        return True in categoryYesNo and False in categoryYesNo
+    
+    '''
+    Returns {tagName : (categoryYes, categoryNo)} for the tag names, creating the
+    categories that don't exist yet.
+    '''
+    def getCategoryPairs(self, tagNames):
+        with self.__lock :
+            self.__load()
+            missing = set(tagName for tagName in tagNames if not self.__isComplete(tagName))
+            if missing :
+                # Another process may have created them since the registry was loaded
+                self.__add(ClassifierCategory.objects.filter(categoryName__in=missing))
+                missing = [tagName for tagName in missing if not self.__isComplete(tagName)]
+            if missing :
+                self.__createCategories(missing)
+            
+            return dict((tagName, (self.__categoriesByName[tagName][True], self.__categoriesByName[tagName][False])) 
+                        for tagName in tagNames)
+    
+    def __createCategories(self, tagNames):
+        newCategories = []
+        for tagName in tagNames :
+            for yes in (True, False) :
+                if yes not in self.__categoriesByName.get(tagName, {}) :
+                    newCategories.append(ClassifierCategory(categoryName=tagName, yes=yes))
+        
+        savepoint = transaction.savepoint()
+        self.__creating = True
+        try :
+            try :
+                ClassifierCategory.objects.bulk_create(newCategories)
+                transaction.savepoint_commit(savepoint)
+            except IntegrityError :
+                # A concurrent trainer created some of them first
+                transaction.savepoint_rollback(savepoint)
+                for category in newCategories :
+                    ClassifierCategory.objects.get_or_create(categoryName=category.categoryName, yes=category.yes)
+        finally :
+            self.__creating = False
+        # bulk_create doesn't set the ids
+        self.__add(ClassifierCategory.objects.filter(categoryName__in=tagNames))
+    
+    '''
+    Returns the categories with the given ids, unknown ids are skipped
+    '''
+    def getCategoriesByIds(self, ids):
+        with self.__lock :
+            self.__load()
+            ids = [int(categoryId) for categoryId in ids]
+            if [categoryId for categoryId in ids if categoryId not in self.__categoriesById] :
+                self.__add(ClassifierCategory.objects.filter(id__in=ids))
+            return [self.__categoriesById[categoryId] for categoryId in ids if categoryId in self.__categoriesById]
+    
+    def getAllCategories(self):
+        with self.__lock :
+            self.__load()
+            return self.__categoriesById.values()
+    
+    
+def _invalidateCategoryRegistry(sender, **kwargs):
+    CategoryRegistry.getSharedRegistry().invalidate()
+
+post_save.connect(_invalidateCategoryRegistry, sender=ClassifierCategory)
+post_delete.connect(_invalidateCategoryRegistry, sender=ClassifierCategory)
+
 '''
 Document that we use to train the classifier, stored for easy 
 retrieval later on.
@@ -102,6 +225,11 @@ class Document(models.Model):
         return foundDocument
     
     
+    @staticmethod
+    def getDocumentByHash(corpusHash):
+        documents = Document.objects.filter(corpusHash=corpusHash)[:1]
+        return documents[0] if documents else None
+    
     @staticmethod
     def removeDocumentByCorpus(corpus):
         logger = logging.getLogger("Document.removeDocumentByCorpus")
@@ -130,7 +258,168 @@ taxonomy tree.
 '''
 class FeatureCounts(models.Model):
     featureName = models.CharField(max_length=100, unique=True)
-    countData = models.TextField()
+    # Legacy JSON counts, superseded by FeatureCategoryCount
+    countData = models.TextField(blank=True, default="")
+    
+    '''
+    Retrieves the feature counts for many feature names, querying in chunks
+    so large batches stay below the database's parameter limits.
+    '''
+    @staticmethod
+    def getFeatureCountsByNames(featureNames, chunkSize=500):
+        featureNames = list(featureNames)
+        for start in range(0, len(featureNames), chunkSize) :
+            for featureCount in FeatureCounts.objects.filter(featureName__in=featureNames[start:start + chunkSize]) :
+                yield featureCount
+    
+'''
+Normalized count of a feature for a single category.  Counts are only ever changed
+with atomic increments so concurrent trainers don't lose updates.
+'''
+class FeatureCategoryCount(models.Model):
+    feature = models.ForeignKey(FeatureCounts)
+    category = models.ForeignKey(ClassifierCategory)
+    count = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = (('feature', 'category'),)
+    
+    '''
+    Retrieves (featureName, categoryId, count) for all the given features, in chunks
+    '''
+    @staticmethod
+    def getCountsByFeatureNames(featureNames, chunkSize=500):
+        featureNames = list(featureNames)
+        for start in range(0, len(featureNames), chunkSize) :
+            counts = FeatureCategoryCount.objects.filter(feature__featureName__in=featureNames[start:start + chunkSize])
+            for featureCount in counts.values_list('feature__featureName', 'category', 'count') :
+                yield featureCount
+    
+    '''
+    Retrieves (featureName, categoryId, count) for every non zero count, the counts of
+    a feature are consecutive
+    '''
+    @staticmethod
+    def getAllCounts():
+        counts = FeatureCategoryCount.objects.filter(count__gt=0).order_by('feature')
+        return counts.values_list('feature__featureName', 'category', 'count').iterator()
+    
+    '''
+    Applies count deltas given as {featureName : {categoryId : delta}}.
+    Deltas are grouped so there is one UPDATE per category and delta, missing
+    feature/category rows are upserted.  Counts never drop below zero.
+    '''
+    @staticmethod
+    def addFeatureCounts(featureDeltas, chunkSize=500):
+        featureIds = {}
+        for featureCount in FeatureCounts.getFeatureCountsByNames(featureDeltas.keys()) :
+            featureIds[featureCount.featureName] = featureCount.id
+        
+        groupedDeltas = {}
+        for featureName, categoryDeltas in featureDeltas.items() :
+            for categoryId, delta in categoryDeltas.items() :
+                if delta :
+                    groupedDeltas.setdefault((int(categoryId), delta), []).append(featureName)
+        
+        newFeatures = set()
+        for (categoryId, delta), featureNames in groupedDeltas.items() :
+            if delta > 0 :
+                newFeatures.update(featureName for featureName in featureNames if featureName not in featureIds)
+        if newFeatures :
+            FeatureCategoryCount.__bulkCreate(FeatureCounts, [FeatureCounts(featureName=featureName) for featureName in newFeatures],
+                                              lambda row : FeatureCounts.objects.get_or_create(featureName=row.featureName))
+            for featureCount in FeatureCounts.getFeatureCountsByNames(newFeatures) :
+                featureIds[featureCount.featureName] = featureCount.id
+        
+        for (categoryId, delta), featureNames in groupedDeltas.items() :
+            ids = [featureIds[featureName] for featureName in featureNames if featureName in featureIds]
+            for start in range(0, len(ids), chunkSize) :
+                chunk = ids[start:start + chunkSize]
+                if delta > 0 :
+                    existing = set(FeatureCategoryCount.objects.filter(category=categoryId, feature__in=chunk).values_list('feature', flat=True))
+                    if existing :
+                        FeatureCategoryCount.objects.filter(category=categoryId, feature__in=existing).update(count=F('count') + delta)
+                    missing = [FeatureCategoryCount(feature_id=featureId, category_id=categoryId, count=delta) 
+                               for featureId in chunk if featureId not in existing]
+                    if missing :
+                        FeatureCategoryCount.__bulkCreate(FeatureCategoryCount, missing, 
+                                                          lambda row : FeatureCategoryCount.addCount(row.feature_id, row.category_id, row.count))
+                else :
+                    FeatureCategoryCount.objects.filter(category=categoryId, feature__in=chunk, 
+                                                        count__gte=-delta).update(count=F('count') + delta)
+    
+    '''
+    Bulk creates the rows, if a concurrent trainer created one of them first the 
+    rows are created one at a time with the given fallback instead.
+    '''
+    @staticmethod
+    def __bulkCreate(model, rows, fallback):
+        savepoint = transaction.savepoint()
+        try :
+            model.objects.bulk_create(rows)
+            transaction.savepoint_commit(savepoint)
+        except IntegrityError :
+            transaction.savepoint_rollback(savepoint)
+            for row in rows :
+                fallback(row)
+    
+    '''
+    Upserts a single feature/category count
+    '''
+    @staticmethod
+    def addCount(featureId, categoryId, delta):
+        countRow, created = FeatureCategoryCount.objects.get_or_create(feature_id=featureId, category_id=categoryId, 
+                                                                        defaults={'count' : delta})
+        if not created :
+            FeatureCategoryCount.objects.filter(id=countRow.id).update(count=F('count') + delta)
+    
+    '''
+    Replaces all the feature/category counts with featureCounts, given as 
+    {featureName : {categoryId : count}}.  Should run in a transaction so readers
+    keep seeing the old counts until it commits.
+    '''
+    @staticmethod
+    def replaceAllCounts(featureCounts, chunkSize=1000):
+        featureIds = dict(FeatureCounts.objects.values_list('featureName', 'id').iterator())
+        newFeatures = [featureName for featureName in featureCounts if featureName not in featureIds]
+        for start in range(0, len(newFeatures), chunkSize) :
+            FeatureCounts.objects.bulk_create([FeatureCounts(featureName=featureName) 
+                                               for featureName in newFeatures[start:start + chunkSize]])
+        for featureCount in FeatureCounts.getFeatureCountsByNames(newFeatures) :
+            featureIds[featureCount.featureName] = featureCount.id
+        
+        # A queryset delete would load every row first
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM %s" % connection.ops.quote_name(FeatureCategoryCount._meta.db_table))
+        
+        rows = []
+        for featureName, counts in featureCounts.items() :
+            for categoryId, count in counts.items() :
+                if count > 0 :
+                    rows.append(FeatureCategoryCount(feature_id=featureIds[featureName], category_id=int(categoryId), count=count))
+            if len(rows) >= chunkSize :
+                FeatureCategoryCount.objects.bulk_create(rows)
+                rows = []
+        if rows :
+            FeatureCategoryCount.objects.bulk_create(rows)
+        
+        FeatureCounts.objects.exclude(countData="").update(countData="")
+    
+    '''
+    Moves the legacy JSON FeatureCounts.countData into normalized rows.
+    Returns the number of features migrated.
+    '''
+    @staticmethod
+    def importLegacyCounts():
+        migrated = 0
+        for featureCount in FeatureCounts.objects.exclude(countData="").iterator() :
+            counts = decodeCounts(featureCount.countData)
+            for categoryId, count in counts.items() :
+                if count > 0 :
+                    FeatureCategoryCount.addCount(featureCount.id, categoryId, count)
+            FeatureCounts.objects.filter(id=featureCount.id).update(countData="")
+            migrated += 1
+        return migrated
     
 '''
 Mapping of document to all it's category counts
@@ -138,6 +427,8 @@ Mapping of document to all it's category counts
 class DocumentCategoryCounts(models.Model):
     document = models.ForeignKey(Document, unique=True)
     countData = models.TextField()
+    # The extracted features of the document, so untraining doesn't extract them again
+    featureData = models.TextField(blank=True, default="")
     
     @staticmethod
     def getCategoriesForDocument(document):
@@ -146,17 +437,53 @@ class DocumentCategoryCounts(models.Model):
         categories = None
         try :
             documentCount = DocumentCategoryCounts.objects.get(document=document)
-            jsonDecoder = JSONDecoder()
-            categories = jsonDecoder.decode(documentCount.countData)
-            categories = ClassifierCategory.getCategoriesByIds(categories.keys())
+            categories = documentCount.getCategories()
         except Exception, ex :
             logger.exception("Failed to retrieve the categories for the document" + str(ex))
             
         return categories
     
+    def getCategories(self):
+        return CategoryRegistry.getSharedRegistry().getCategoriesByIds(self.getCounts().keys())
+    
+    '''
+    Returns {categoryId : count} of the document, binary and legacy JSON rows alike
+    '''
+    def getCounts(self):
+        return decodeCounts(self.countData)
+    
+    @staticmethod
+    def encodeCounts(counts):
+        return encodeCounts(counts)
+    
+    '''
+    Rewrites the JSON encoded rows in the binary format.
+    Returns the number of rows rewritten.
+    '''
+    @staticmethod
+    def reencodeLegacyCounts():
+        migrated = 0
+        rows = DocumentCategoryCounts.objects.filter(countData__startswith='{').only('id', 'countData')
+        for row in rows.iterator() :
+            DocumentCategoryCounts.objects.filter(id=row.id).update(countData=encodeCounts(row.getCounts()))
+            migrated += 1
+        return migrated
+    
+    '''
+    Features are stored space separated, the extracted features never contain whitespace.
+    Returns None for documents trained before the features were stored.
+    '''
+    def getFeatures(self):
+        return self.featureData.split() if self.featureData else None
+    
+    @staticmethod
+    def encodeFeatures(features):
+        return " ".join(features)
+    
 '''
 An index of the number of documents classified for a particular category.
 Purely for classification optimization.
+Legacy single row index, superseded by the sharded CategoryDocumentCount.
 '''
 class CategoryDocumentCountIndex(models.Model):
     indexId = models.IntegerField(unique=True, db_index=True)
@@ -167,4 +494,159 @@ class CategoryDocumentCountIndex(models.Model):
         index,_ = CategoryDocumentCountIndex.objects.get_or_create(indexId=0)
         return index
     
-    
\ No newline at end of file
+
+'''
+Number of documents trained for a category, split over CLASSIFIER_DOCUMENT_COUNT_SHARDS 
+counter rows per category.  Trainers increment a random shard, so concurrent trainers 
+rarely wait on the same row lock.  The count of a category is the sum of its shards.
+'''
+class CategoryDocumentCount(models.Model):
+    category = models.ForeignKey(ClassifierCategory)
+    shard = models.IntegerField(default=0)
+    count = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = (('category', 'shard'),)
+    
+    '''
+    Applies document count deltas given as {categoryId : delta}, counts never drop below zero
+    '''
+    @staticmethod
+    def addDocumentCounts(categoryDeltas):
+        numShards = getattr(settings, 'CLASSIFIER_DOCUMENT_COUNT_SHARDS', 8)
+        for categoryId, delta in categoryDeltas.items() :
+            categoryId = int(categoryId)
+            shard = random.randrange(numShards)
+            if delta > 0 :
+                updated = CategoryDocumentCount.objects.filter(category=categoryId, shard=shard).update(count=F('count') + delta)
+                if not updated :
+                    countRow, created = CategoryDocumentCount.objects.get_or_create(category_id=categoryId, shard=shard, 
+                                                                                    defaults={'count' : delta})
+                    if not created :
+                        CategoryDocumentCount.objects.filter(id=countRow.id).update(count=F('count') + delta)
+            elif delta < 0 :
+                updated = CategoryDocumentCount.objects.filter(category=categoryId, shard=shard, 
+                                                               count__gte=-delta).update(count=F('count') + delta)
+                if not updated :
+                    # The random shard is empty, take the documents from any shard that has them
+                    for countId in CategoryDocumentCount.objects.filter(category=categoryId, count__gte=-delta).values_list('id', flat=True) :
+                        if CategoryDocumentCount.objects.filter(id=countId, count__gte=-delta).update(count=F('count') + delta) :
+                            break
+    
+    '''
+    Replaces the document counts with {categoryId : count}
+    '''
+    @staticmethod
+    def setDocumentCounts(counts):
+        CategoryDocumentCount.objects.all().delete()
+        CategoryDocumentCount.objects.bulk_create([CategoryDocumentCount(category_id=int(categoryId), shard=0, count=count) 
+                                                   for categoryId, count in counts.items() if count > 0])
+    
+    '''
+    Returns the number of documents trained per category, keyed by category id
+    '''
+    @staticmethod
+    def getDocumentCounts():
+        counts = CategoryDocumentCount.objects.values_list('category').annotate(total=Sum('count'))
+        return dict((categoryId, total) for categoryId, total in counts)
+    
+    '''
+    Moves the legacy CategoryDocumentCountIndex counts into the counter rows.
+    Returns the number of categories migrated.
+    '''
+    @staticmethod
+    def importLegacyCounts():
+        countIndex = CategoryDocumentCountIndex.getCountIndex()
+        counts = decodeCounts(countIndex.countData)
+        CategoryDocumentCount.addDocumentCounts(dict((categoryId, count) for categoryId, count in counts.items() if count > 0))
+        countIndex.countData = ""
+        countIndex.save()
+        return len(counts)
+    
+
+'''
+Version of the trained model.  Every train/untrain bumps the version so that
+long lived classifier indexes know when their cached counts have gone stale.
+Like the document counts the version is split over shard rows, the version is 
+their sum.
+'''
+class ClassifierModelVersion(models.Model):
+    versionId = models.IntegerField(unique=True, db_index=True)
+    version = models.IntegerField(default=0)
+    
+    @staticmethod
+    def getVersion():
+        return ClassifierModelVersion.objects.aggregate(total=Sum('version'))['total'] or 0
+    
+    '''
+    Atomically increments the model version, should be called within the 
+    transaction that modifies the counts.
+    '''
+    @staticmethod
+    def bumpVersion():
+        shard = random.randrange(getattr(settings, 'CLASSIFIER_DOCUMENT_COUNT_SHARDS', 8))
+        updated = ClassifierModelVersion.objects.filter(versionId=shard).update(version=F('version') + 1)
+        if not updated :
+            modelVersion, created = ClassifierModelVersion.objects.get_or_create(versionId=shard, defaults={'version' : 1})
+            if not created :
+                ClassifierModelVersion.objects.filter(id=modelVersion.id).update(version=F('version') + 1)
+    
+
+'''
+Append only log of the count changes made by the trainer, written in the same 
+transaction as the counts.  Long lived classifier indexes apply the changes logged
+since they were loaded instead of reloading all the counts.  A reload row tells the
+indexes to reload everything, it is written when the counts are replaced wholesale.
+'''
+class CountChangeLog(models.Model):
+    # {featureName : {categoryId : delta}} and {categoryId : delta}, JSON encoded
+    featureDeltas = models.TextField(blank=True, default="")
+    categoryDeltas = models.TextField(blank=True, default="")
+    documentsDelta = models.IntegerField(default=0)
+    reload = models.BooleanField(default=False)
+    
+    @staticmethod
+    def record(featureDeltas, categoryDeltas, documentsDelta):
+        encoder = JSONEncoder()
+        CountChangeLog(featureDeltas=encoder.encode(featureDeltas), categoryDeltas=encoder.encode(categoryDeltas),
+                       documentsDelta=documentsDelta).save()
+    
+    @staticmethod
+    def recordReload():
+        CountChangeLog(reload=True).save()
+    
+    '''
+    Returns the sequence numbers of the changes after sequence, in order
+    '''
+    @staticmethod
+    def getSequencesSince(sequence):
+        return list(CountChangeLog.objects.filter(id__gt=sequence).order_by('id').values_list('id', flat=True))
+    
+    @staticmethod
+    def getLastSequence():
+        return CountChangeLog.objects.aggregate(last=Max('id'))['last'] or 0
+    
+    '''
+    Returns the changes with the given sequence numbers, in order
+    '''
+    @staticmethod
+    def getChanges(sequences):
+        return CountChangeLog.objects.filter(id__in=list(sequences)).order_by('id')
+    
+    '''
+    Deletes the changes up to sequence.  Indexes that haven't applied them yet
+    are told to reload.
+    '''
+    @staticmethod
+    def prune(sequence):
+        CountChangeLog.recordReload()
+        CountChangeLog.objects.filter(id__lte=sequence).delete()
+    
+    def getFeatureDeltas(self):
+        featureDeltas = JSONDecoder().decode(self.featureDeltas) if self.featureDeltas else {}
+        return dict((featureName, dict((int(categoryId), delta) for categoryId, delta in deltas.items())) 
+                    for featureName, deltas in featureDeltas.items())
+    
+    def getCategoryDeltas(self):
+        categoryDeltas = JSONDecoder().decode(self.categoryDeltas) if self.categoryDeltas else {}
+        return dict((int(categoryId), delta) for categoryId, delta in categoryDeltas.items())
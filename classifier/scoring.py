@@ -0,0 +1,130 @@
+'''
+Vectorized scoring of every category at once with NumPy.
+
+The loaded feature counts are laid out as features x categories matrices and the
+weighted average probabilities, their products (summed in log space) and the fisher
+inverse chi square are computed with a handful of array operations.  NumPy is
+optional, the classifiers fall back to the pure python scoring without it.  It is
+imported the first time vectorized scoring is used.
+'''
+numpy = None
+_numpyImported = False
+
+WEIGHT = 1.0
+ASSUMED_PROB = 0.5
+
+def isAvailable():
+    global numpy, _numpyImported
+    if not _numpyImported :
+        try :
+            import numpy
+        except ImportError :
+            numpy = None
+        _numpyImported = True
+    return numpy is not None
+
+
+class VectorizedScorer(object):
+
+    def __init__(self, classifierIndex, groupedCategories):
+        isAvailable()
+        self.__classifierIndex = classifierIndex
+        self.__groupedCategories = groupedCategories
+        # Read before the document counts, a change applied meanwhile makes the scorer stale
+        self.__revision = classifierIndex.getRevision()
+        self.__tagNames = []
+        self.__columns = {}
+
+        yesDocuments = []
+        noDocuments = []
+        for tagName, categoryYesNo in groupedCategories.items() :
+            if True not in categoryYesNo or False not in categoryYesNo :
+                continue
+            column = len(self.__tagNames)
+            self.__tagNames.append(tagName)
+            self.__columns[categoryYesNo[True].id] = (column, True)
+            self.__columns[categoryYesNo[False].id] = (column, False)
+            yesDocuments.append(classifierIndex.getNumDocumentsForCategory(categoryYesNo[True]))
+            noDocuments.append(classifierIndex.getNumDocumentsForCategory(categoryYesNo[False]))
+
+        self.__yesDocuments = numpy.array(yesDocuments, dtype=float)
+        self.__noDocuments = numpy.array(noDocuments, dtype=float)
+
+    '''
+    True if the scorer was built for the given index and categories and can be reused.
+    The document counts are copied, so the index must not have changed since.
+    '''
+    def isFor(self, classifierIndex, groupedCategories):
+        return self.__classifierIndex is classifierIndex and self.__groupedCategories is groupedCategories \
+            and self.__revision == classifierIndex.getRevision()
+
+    def getTagNames(self):
+        return self.__tagNames
+
+    '''
+    Returns the log probabilities of the yes and no category of every tag,
+    log(numDocuments) + sum(log(weightedAverage)) as computed by the BayesianClassifier
+    '''
+    def getBayesianLogProbs(self, features):
+        yesCounts, noCounts = self.__getCountMatrices(features)
+        totals = yesCounts + noCounts
+        return (self.__getBayesianLogProb(yesCounts, totals, self.__yesDocuments),
+                self.__getBayesianLogProb(noCounts, totals, self.__noDocuments))
+
+    '''
+    Returns the fisher probabilities of the yes and no category of every tag
+    '''
+    def getFisherProbs(self, features):
+        yesCounts, noCounts = self.__getCountMatrices(features)
+        totals = yesCounts + noCounts
+        return (self.__getFisherProb(yesCounts, noCounts, totals, self.__yesDocuments, len(features)),
+                self.__getFisherProb(noCounts, yesCounts, totals, self.__noDocuments, len(features)))
+
+    '''
+    Only the non zero counts of each feature are visited
+    '''
+    def __getCountMatrices(self, features):
+        yesCounts = numpy.zeros((len(features), len(self.__tagNames)))
+        noCounts = numpy.zeros((len(features), len(self.__tagNames)))
+
+        for row, feature in enumerate(features) :
+            for categoryId, count in self.__classifierIndex.getFeatureCounts(feature).items() :
+                column = self.__columns.get(categoryId)
+                if column :
+                    counts = yesCounts if column[1] else noCounts
+                    counts[row, column[0]] = count
+        return yesCounts, noCounts
+
+    def __divide(self, counts, numDocuments):
+        return counts / numpy.where(numDocuments > 0, numDocuments, 1.0)
+
+    def __getLogWeightedAverage(self, basicProbs, totals):
+        return numpy.log(((WEIGHT * ASSUMED_PROB) + (totals * basicProbs)) / (WEIGHT + totals)).sum(axis=0)
+
+    def __getBayesianLogProb(self, counts, totals, numDocuments):
+        basicProbs = self.__divide(counts, numDocuments)
+        with numpy.errstate(divide='ignore') :
+            logProbs = self.__getLogWeightedAverage(basicProbs, totals) + numpy.log(numDocuments)
+        return numpy.where(numDocuments > 0, logProbs, -numpy.inf)
+
+    def __getFisherProb(self, counts, otherCounts, totals, numDocuments, numFeatures):
+        basicProbs = self.__divide(counts, numDocuments)
+        freqSums = basicProbs + self.__divide(otherCounts, numDocuments)
+        basicProbs = numpy.where(basicProbs > 0, basicProbs / numpy.where(freqSums > 0, freqSums, 1.0), basicProbs)
+
+        probs = self.__invchi2(-2 * self.__getLogWeightedAverage(basicProbs, totals), numFeatures * 2)
+        return numpy.where(numDocuments > 0, probs, 0.0)
+
+    '''
+    Sum of the poisson terms m^i * e^-m / i! for i < df/2, computed in log space
+    '''
+    def __invchi2(self, chi, df):
+        m = chi / 2.0
+        i = numpy.arange(max(df // 2, 1))
+        logFactorials = numpy.concatenate(([0.0], numpy.cumsum(numpy.log(i[1:]))))
+
+        with numpy.errstate(divide='ignore', invalid='ignore') :
+            logPowers = numpy.where(i == 0, 0.0, i * numpy.log(m)[:, numpy.newaxis])
+        terms = numpy.exp(logPowers - m[:, numpy.newaxis] - logFactorials)
+        return numpy.minimum(terms.sum(axis=1), 1.0)
+
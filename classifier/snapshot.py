@@ -0,0 +1,193 @@
+'''
+Compiled, read only snapshot of the trained model.
+
+The snapshot packs the categories, their document counts and a sorted feature table
+with the feature/category counts into a single file.  The file is mmap'ed read only,
+so every worker process on a box shares the same pages and can classify without
+touching the database.
+
+Layout, all little endian:
+    header           MAGIC, model version, number of documents, #categories, #features, #counts
+    categories       (id, yes, document count) int32 triples
+    category names   (#categories + 1) uint32 offsets followed by the utf-8 names
+    feature names    (#features + 1) uint32 offsets into the feature name blob
+    feature counts   (#features + 1) uint32 offsets into the count arrays
+    category ids     #counts int32
+    counts           #counts int32
+    feature name blob, utf-8 names sorted bytewise
+'''
+from array import array
+from classifier.models import ClassifierCategory, Document, FeatureCategoryCount, \
+    CategoryDocumentCount, ClassifierModelVersion
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = 'CLSNAP01'
+HEADER = struct.Struct('<8sqqIII')
+CATEGORY = struct.Struct('<iii')
+OFFSET = struct.Struct('<I')
+COUNT = struct.Struct('<i')
+
+class SnapshotFormatException(Exception):
+    def __init__(self, value):
+        self.message = value
+
+    def __str__(self):
+        return repr(self.message)
+
+
+def encodeFeatureName(featureName):
+    if isinstance(featureName, unicode) :
+        return featureName.encode('utf-8')
+    return featureName
+
+def _toLittleEndian(values):
+    if sys.byteorder != 'little' :
+        values.byteswap()
+    return values.tostring()
+
+'''
+Writes a snapshot to path.
+categories is a list of (id, categoryName, yes, documentCount) and featureCounts maps
+featureName to a list of (categoryId, count).  The file is written next to path and
+renamed over it, so processes that still map the old snapshot are unaffected.
+'''
+def writeSnapshot(path, version, numberOfDocuments, categories, featureCounts):
+    featureNames = sorted(encodeFeatureName(featureName) for featureName in featureCounts)
+    byName = dict((encodeFeatureName(featureName), counts) for featureName, counts in featureCounts.items())
+
+    categoryNames = [encodeFeatureName(categoryName) for _, categoryName, _, _ in categories]
+    categoryNameOffsets = array('I', [0])
+    for categoryName in categoryNames :
+        categoryNameOffsets.append(categoryNameOffsets[-1] + len(categoryName))
+
+    featureNameOffsets = array('I', [0])
+    featureCountOffsets = array('I', [0])
+    categoryIds = array('i')
+    counts = array('i')
+    for featureName in featureNames :
+        featureNameOffsets.append(featureNameOffsets[-1] + len(featureName))
+        for categoryId, count in sorted(byName[featureName]) :
+            categoryIds.append(categoryId)
+            counts.append(count)
+        featureCountOffsets.append(len(counts))
+
+    tempPath = path + '.tmp'
+    snapshotFile = open(tempPath, 'wb')
+    try :
+        snapshotFile.write(HEADER.pack(MAGIC, version, numberOfDocuments, len(categories), len(featureNames), len(counts)))
+        for categoryId, _, yes, documentCount in categories :
+            snapshotFile.write(CATEGORY.pack(categoryId, 1 if yes else 0, documentCount))
+        snapshotFile.write(_toLittleEndian(categoryNameOffsets))
+        snapshotFile.write(''.join(categoryNames))
+        snapshotFile.write(_toLittleEndian(featureNameOffsets))
+        snapshotFile.write(_toLittleEndian(featureCountOffsets))
+        snapshotFile.write(_toLittleEndian(categoryIds))
+        snapshotFile.write(_toLittleEndian(counts))
+        snapshotFile.write(''.join(featureNames))
+    finally :
+        snapshotFile.close()
+    os.rename(tempPath, path)
+
+'''
+Compiles the current model in the database into a snapshot at path.
+Returns the model version of the snapshot.
+'''
+def compileSnapshot(path):
+    version = ClassifierModelVersion.getVersion()
+    documentCounts = CategoryDocumentCount.getDocumentCounts()
+    categories = [(category.id, category.categoryName, category.yes, documentCounts.get(category.id, 0))
+                  for category in ClassifierCategory.objects.all().order_by('id')]
+
+    featureCounts = {}
+    for featureName, categoryId, count in FeatureCategoryCount.getAllCounts() :
+        featureCounts.setdefault(featureName, []).append((categoryId, count))
+
+    writeSnapshot(path, version, Document.objects.count(), categories, featureCounts)
+    return version
+
+
+'''
+Read only view of a snapshot file, feature lookups binary search the mapped
+feature table without copying it into the process.
+'''
+class ModelSnapshot(object):
+
+    def __init__(self, path):
+        self.path = path
+        snapshotFile = open(path, 'rb')
+        try :
+            self.mtime = os.fstat(snapshotFile.fileno()).st_mtime
+            self.__map = mmap.mmap(snapshotFile.fileno(), 0, access=mmap.ACCESS_READ)
+        finally :
+            snapshotFile.close()
+
+        magic, self.version, self.numberOfDocuments, numCategories, self.numFeatures, numCounts = HEADER.unpack_from(self.__map, 0)
+        if magic != MAGIC :
+            raise SnapshotFormatException("Not a classifier snapshot: %s" % path)
+
+        offset = HEADER.size
+        categoryTable = offset
+        offset += numCategories * CATEGORY.size
+        categoryNameOffsets = offset
+        offset += (numCategories + 1) * OFFSET.size
+        categoryNames = offset
+        offset += self.__getOffset(categoryNameOffsets, numCategories)
+        self.__featureNameOffsets = offset
+        offset += (self.numFeatures + 1) * OFFSET.size
+        self.__featureCountOffsets = offset
+        offset += (self.numFeatures + 1) * OFFSET.size
+        self.__categoryIds = offset
+        offset += numCounts * COUNT.size
+        self.__counts = offset
+        offset += numCounts * COUNT.size
+        self.__featureNames = offset
+
+        # The categories are small, everything else stays in the mapped pages
+        self.categories = []
+        for i in range(numCategories) :
+            categoryId, yes, documentCount = CATEGORY.unpack_from(self.__map, categoryTable + i * CATEGORY.size)
+            start = categoryNames + self.__getOffset(categoryNameOffsets, i)
+            end = categoryNames + self.__getOffset(categoryNameOffsets, i + 1)
+            self.categories.append((categoryId, self.__map[start:end].decode('utf-8'), bool(yes), documentCount))
+
+    def __getOffset(self, table, i):
+        return OFFSET.unpack_from(self.__map, table + i * OFFSET.size)[0]
+
+    def __getFeatureName(self, i):
+        start = self.__featureNames + self.__getOffset(self.__featureNameOffsets, i)
+        end = self.__featureNames + self.__getOffset(self.__featureNameOffsets, i + 1)
+        return self.__map[start:end]
+
+    def __findFeature(self, featureName):
+        low, high = 0, self.numFeatures
+        while low < high :
+            middle = (low + high) // 2
+            if self.__getFeatureName(middle) < featureName :
+                low = middle + 1
+            else :
+                high = middle
+        if low < self.numFeatures and self.__getFeatureName(low) == featureName :
+            return low
+        return -1
+
+    '''
+    Returns the counts of a feature keyed by category id, empty if the feature is unknown
+    '''
+    def getFeatureCounts(self, featureName):
+        i = self.__findFeature(encodeFeatureName(featureName))
+        if i < 0 :
+            return {}
+        start = self.__getOffset(self.__featureCountOffsets, i)
+        end = self.__getOffset(self.__featureCountOffsets, i + 1)
+        counts = {}
+        for j in range(start, end) :
+            categoryId = COUNT.unpack_from(self.__map, self.__categoryIds + j * COUNT.size)[0]
+            counts[categoryId] = COUNT.unpack_from(self.__map, self.__counts + j * COUNT.size)[0]
+        return counts
+
+    def close(self):
+        self.__map.close()
+
@@ -0,0 +1,505 @@
+'''
+Count stores hold what the trainer writes and the classifiers read: the categories,
+the trained documents, the feature/category counts and the category document counts.
+
+DjangoCountStore keeps them in the database through the models, it is what the trainer
+and classifiers use by default, the classifier indexes read their counts through it.
+MemoryCountStore keeps them in dicts, for offline experiments and batch scoring that
+don't need the database, and can be saved to and loaded from disk.
+
+    store = MemoryCountStore()
+    trainer = Trainer()
+    trainer.setCountStore(store)
+    trainer.trainMany(documents)
+    classifier = FisherBayesClassifier()
+    classifier.setCountStore(store)
+'''
+from classifier.classifiers import ClassifierIndex
+from classifier.models import ClassifierCategory, CategoryRegistry, Document, DocumentCategoryCounts, \
+    FeatureCategoryCount, CategoryDocumentCount, ClassifierModelVersion, CountChangeLog
+from classifier.snapshot import writeSnapshot
+from django.db import transaction
+import cPickle
+import os
+import threading
+
+# Stands for an entry a rolled back transaction added, see MemoryCountStore.rollback
+_MISSING = object()
+
+'''
+A trained document as seen by the trainer, categoryCounts is {categoryId : count} and
+features is None when they weren't stored.  handle is whatever the store needs to find
+the document again.
+'''
+class TrainedDocument(object):
+
+    def __init__(self, documentId, corpus, corpusHash, categoryCounts, features, handle=None):
+        self.documentId = documentId
+        self.handle = handle
+        self.corpus = corpus
+        self.corpusHash = corpusHash
+        self.categoryCounts = categoryCounts
+        self.features = features
+
+
+'''
+Interface of the count stores.  Writes happen between begin() and either commit() or,
+when anything failed including the commit, rollback().
+'''
+class CountStore(object):
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    '''
+    Returns {tagName : (categoryYes, categoryNo)}, creating the missing categories
+    '''
+    def getCategoryPairs(self, tagNames):
+        raise NotImplementedError
+
+    def getCategoriesByIds(self, ids):
+        raise NotImplementedError
+
+    def getAllCategories(self):
+        raise NotImplementedError
+
+    '''
+    Returns the TrainedDocument with the given id or corpus hash, None if it isn't trained
+    '''
+    def getTrainedDocument(self, documentId=None, corpusHash=None):
+        raise NotImplementedError
+
+    '''
+    Returns the hashes of the given corpus hashes that are already trained
+    '''
+    def getTrainedHashes(self, corpusHashes):
+        raise NotImplementedError
+
+    '''
+    Stores new documents given as (corpus, corpusHash, {categoryId : count}, features)
+    '''
+    def addDocuments(self, documents):
+        raise NotImplementedError
+
+    def removeDocument(self, trainedDocument):
+        raise NotImplementedError
+
+    def setDocumentCategories(self, trainedDocument, categoryCounts, features):
+        raise NotImplementedError
+
+    '''
+    Applies {featureName : {categoryId : delta}}, {categoryId : delta} and the change in
+    the number of documents.  Counts never drop below zero.
+    '''
+    def addCounts(self, featureDeltas, categoryDeltas, documentsDelta):
+        raise NotImplementedError
+
+    '''
+    Yields (featureName, categoryId, count) for the given features
+    '''
+    def getCountsByFeatureNames(self, featureNames):
+        raise NotImplementedError
+
+    def getDocumentCounts(self):
+        raise NotImplementedError
+
+    def getNumberOfDocuments(self):
+        raise NotImplementedError
+
+    def getVersion(self):
+        raise NotImplementedError
+
+    '''
+    Returns a classifier index over the counts with the given features loaded
+    '''
+    def getClassifierIndex(self, features):
+        raise NotImplementedError
+
+
+'''
+The database through the Django models
+'''
+class DjangoCountStore(CountStore):
+
+    __sharedStore = None
+
+    @staticmethod
+    def getSharedStore():
+        if DjangoCountStore.__sharedStore is None :
+            DjangoCountStore.__sharedStore = DjangoCountStore()
+        return DjangoCountStore.__sharedStore
+
+    '''
+    Same as the transaction.commit_manually decorator
+    '''
+    def begin(self):
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+
+    def commit(self):
+        transaction.commit()
+        transaction.leave_transaction_management()
+
+    '''
+    Categories created by a rolled back transaction don't exist, so the registry
+    has to forget them
+    '''
+    def rollback(self):
+        try :
+            transaction.rollback()
+        finally :
+            transaction.leave_transaction_management()
+            CategoryRegistry.getSharedRegistry().invalidate()
+
+    def getCategoryPairs(self, tagNames):
+        return CategoryRegistry.getSharedRegistry().getCategoryPairs(tagNames)
+
+    def getCategoriesByIds(self, ids):
+        return CategoryRegistry.getSharedRegistry().getCategoriesByIds(ids)
+
+    def getAllCategories(self):
+        return CategoryRegistry.getSharedRegistry().getAllCategories()
+
+    def getTrainedDocument(self, documentId=None, corpusHash=None):
+        if documentId is not None :
+            documents = Document.objects.filter(id=documentId)[:1]
+            document = documents[0] if documents else None
+        else :
+            document = Document.getDocumentByHash(corpusHash)
+        if document is None :
+            return None
+
+        try :
+            documentCounts = DocumentCategoryCounts.objects.get(document=document)
+        except DocumentCategoryCounts.DoesNotExist :
+            # Saved without being trained, for instance by Document.getDocumentByCorpus
+            return TrainedDocument(document.id, document.corpus, document.corpusHash, {}, None, document)
+        return TrainedDocument(document.id, document.corpus, document.corpusHash,
+                               documentCounts.getCounts(), documentCounts.getFeatures(), document)
+
+    def getTrainedHashes(self, corpusHashes):
+        return set(Document.objects.filter(corpusHash__in=list(corpusHashes)).values_list('corpusHash', flat=True))
+
+    def addDocuments(self, documents):
+        if len(documents) == 1 :
+            corpus, corpusHash, categoryCounts, features = documents[0]
+            document = Document(corpus=corpus)
+            document.save()
+            DocumentCategoryCounts(document=document, countData=DocumentCategoryCounts.encodeCounts(categoryCounts),
+                                   featureData=DocumentCategoryCounts.encodeFeatures(features)).save()
+            return
+
+        byHash = dict((corpusHash, (categoryCounts, features)) for _, corpusHash, categoryCounts, features in documents)
+        Document.objects.bulk_create([Document(corpus=corpus, corpusHash=corpusHash) for corpus, corpusHash, _, _ in documents])
+        documentCategoryCounts = []
+        for document in Document.objects.filter(corpusHash__in=byHash.keys()).only('id', 'corpusHash') :
+            categoryCounts, features = byHash[document.corpusHash]
+            documentCategoryCounts.append(DocumentCategoryCounts(document=document, countData=DocumentCategoryCounts.encodeCounts(categoryCounts),
+                                                                 featureData=DocumentCategoryCounts.encodeFeatures(features)))
+        DocumentCategoryCounts.objects.bulk_create(documentCategoryCounts)
+
+    def removeDocument(self, trainedDocument):
+        trainedDocument.handle.delete()
+
+    def setDocumentCategories(self, trainedDocument, categoryCounts, features):
+        countData = DocumentCategoryCounts.encodeCounts(categoryCounts)
+        featureData = DocumentCategoryCounts.encodeFeatures(features)
+        if not DocumentCategoryCounts.objects.filter(document=trainedDocument.handle).update(countData=countData, featureData=featureData) :
+            DocumentCategoryCounts(document=trainedDocument.handle, countData=countData, featureData=featureData).save()
+
+    def addCounts(self, featureDeltas, categoryDeltas, documentsDelta):
+        FeatureCategoryCount.addFeatureCounts(featureDeltas)
+        #We keep an index of category document counts for faster classification later on
+        CategoryDocumentCount.addDocumentCounts(categoryDeltas)
+        CountChangeLog.record(featureDeltas, categoryDeltas, documentsDelta)
+        ClassifierModelVersion.bumpVersion()
+
+    def getCountsByFeatureNames(self, featureNames):
+        return FeatureCategoryCount.getCountsByFeatureNames(featureNames)
+
+    def getDocumentCounts(self):
+        return CategoryDocumentCount.getDocumentCounts()
+
+    def getNumberOfDocuments(self):
+        return Document.objects.count()
+
+    def getVersion(self):
+        return ClassifierModelVersion.getVersion()
+
+    def getClassifierIndex(self, features):
+        return ClassifierIndex.getSharedIndex(features)
+
+
+'''
+Everything in dicts.  Writes are applied immediately and the entries they replace are
+kept until commit, rollback puts them back.  Changed count dicts are replaced rather
+than modified, so the store can be trained while other threads classify against it.
+'''
+class MemoryCountStore(CountStore):
+
+    def __init__(self):
+        self.__lock = threading.RLock()
+        self.__categories = {}
+        self.__categoryPairs = {}
+        self.__documents = {}
+        self.__documentsById = {}
+        self.__featureCounts = {}
+        self.__documentCounts = {}
+        self.__version = 0
+        self.__classifierIndex = None
+        self.__undo = None
+
+    def __getstate__(self):
+        with self.__lock :
+            state = self.__dict__.copy()
+            del state['_MemoryCountStore__lock']
+            state['_MemoryCountStore__categories'] = dict((category.id, (category.categoryName, category.yes))
+                                                          for category in self.__categories.values())
+            del state['_MemoryCountStore__categoryPairs']
+            state['_MemoryCountStore__classifierIndex'] = None
+            state['_MemoryCountStore__undo'] = None
+            return state
+
+    def __setstate__(self, state):
+        categories = state.pop('_MemoryCountStore__categories')
+        self.__dict__.update(state)
+        self.__lock = threading.RLock()
+        self.__categories = {}
+        self.__categoryPairs = {}
+        for categoryId, (categoryName, yes) in categories.items() :
+            self.__addCategory(ClassifierCategory(id=categoryId, categoryName=categoryName, yes=yes))
+
+    '''
+    Writes the store to path, replacing it atomically
+    '''
+    def save(self, path):
+        tempPath = path + '.tmp'
+        storeFile = open(tempPath, 'wb')
+        try :
+            cPickle.dump(self, storeFile, cPickle.HIGHEST_PROTOCOL)
+        finally :
+            storeFile.close()
+        os.rename(tempPath, path)
+
+    @staticmethod
+    def load(path):
+        storeFile = open(path, 'rb')
+        try :
+            return cPickle.load(storeFile)
+        finally :
+            storeFile.close()
+
+    '''
+    Compiles the counts into a model snapshot at path, see classifier.snapshot
+    '''
+    def writeSnapshot(self, path):
+        with self.__lock :
+            categories = [(category.id, category.categoryName, category.yes, self.__documentCounts.get(category.id, 0))
+                          for _, category in sorted(self.__categories.items())]
+            featureCounts = dict((featureName, counts.items()) for featureName, counts in self.__featureCounts.items() if counts)
+            writeSnapshot(path, self.__version, len(self.__documents), categories, featureCounts)
+
+    '''
+    The store is locked from begin() to commit() or rollback(), one transaction writes
+    at a time
+    '''
+    def begin(self):
+        self.__lock.acquire()
+        self.__undo = {'categories' : [], 'documents' : {}, 'documentsById' : {}, 'featureCounts' : {},
+                       'documentCounts' : self.__documentCounts, 'version' : self.__version}
+
+    def commit(self):
+        self.__undo = None
+        self.__lock.release()
+
+    def rollback(self):
+        try :
+            undo = self.__undo
+            if undo is not None :
+                for categoryId in undo['categories'] :
+                    category = self.__categories.pop(categoryId)
+                    pair = self.__categoryPairs[category.categoryName]
+                    del pair[category.yes]
+                    if not pair :
+                        del self.__categoryPairs[category.categoryName]
+                self.__restore(self.__documents, undo['documents'])
+                self.__restore(self.__documentsById, undo['documentsById'])
+                self.__restore(self.__featureCounts, undo['featureCounts'])
+                self.__documentCounts = undo['documentCounts']
+                self.__version = undo['version']
+        finally :
+            self.__undo = None
+            self.__lock.release()
+
+    '''
+    Keeps the entry of entries at key before the transaction first changes it
+    '''
+    def __remember(self, name, entries, key):
+        if self.__undo is not None :
+            saved = self.__undo[name]
+            if key not in saved :
+                saved[key] = entries.get(key, _MISSING)
+
+    def __restore(self, entries, saved):
+        for key, value in saved.items() :
+            if value is _MISSING :
+                entries.pop(key, None)
+            else :
+                entries[key] = value
+
+    def __addCategory(self, category):
+        self.__categories[category.id] = category
+        self.__categoryPairs.setdefault(category.categoryName, {})[category.yes] = category
+
+    def getCategoryPairs(self, tagNames):
+        with self.__lock :
+            for tagName in tagNames :
+                for yes in (True, False) :
+                    if yes not in self.__categoryPairs.get(tagName, {}) :
+                        category = ClassifierCategory(id=len(self.__categories) + 1, categoryName=tagName, yes=yes)
+                        self.__addCategory(category)
+                        if self.__undo is not None :
+                            self.__undo['categories'].append(category.id)
+            return dict((tagName, (self.__categoryPairs[tagName][True], self.__categoryPairs[tagName][False]))
+                        for tagName in tagNames)
+
+    def getCategoriesByIds(self, ids):
+        return [self.__categories[int(categoryId)] for categoryId in ids if int(categoryId) in self.__categories]
+
+    def getAllCategories(self):
+        return self.__categories.values()
+
+    def getTrainedDocument(self, documentId=None, corpusHash=None):
+        if documentId is not None :
+            corpusHash = self.__documentsById.get(documentId)
+        document = self.__documents.get(corpusHash)
+        if document is None :
+            return None
+        documentId, corpus, categoryCounts, features = document
+        return TrainedDocument(documentId, corpus, corpusHash, dict(categoryCounts), features, documentId)
+
+    def getTrainedHashes(self, corpusHashes):
+        return set(corpusHash for corpusHash in corpusHashes if corpusHash in self.__documents)
+
+    def addDocuments(self, documents):
+        with self.__lock :
+            for corpus, corpusHash, categoryCounts, features in documents :
+                documentId = len(self.__documentsById) + 1
+                while documentId in self.__documentsById :
+                    documentId += 1
+                self.__remember('documents', self.__documents, corpusHash)
+                self.__remember('documentsById', self.__documentsById, documentId)
+                self.__documents[corpusHash] = (documentId, corpus, dict(categoryCounts), list(features))
+                self.__documentsById[documentId] = corpusHash
+
+    def removeDocument(self, trainedDocument):
+        with self.__lock :
+            self.__remember('documents', self.__documents, trainedDocument.corpusHash)
+            self.__remember('documentsById', self.__documentsById, trainedDocument.handle)
+            self.__documents.pop(trainedDocument.corpusHash, None)
+            self.__documentsById.pop(trainedDocument.handle, None)
+
+    def setDocumentCategories(self, trainedDocument, categoryCounts, features):
+        with self.__lock :
+            self.__remember('documents', self.__documents, trainedDocument.corpusHash)
+            self.__documents[trainedDocument.corpusHash] = (trainedDocument.documentId, trainedDocument.corpus,
+                                                            dict(categoryCounts), list(features))
+
+    def addCounts(self, featureDeltas, categoryDeltas, documentsDelta):
+        with self.__lock :
+            for featureName, deltas in featureDeltas.items() :
+                self.__remember('featureCounts', self.__featureCounts, featureName)
+                self.__featureCounts[featureName] = self.__addDeltas(self.__featureCounts.get(featureName, {}), deltas)
+            self.__documentCounts = self.__addDeltas(self.__documentCounts, categoryDeltas)
+            self.__version += 1
+
+    def __addDeltas(self, counts, deltas):
+        counts = dict(counts)
+        for categoryId, delta in deltas.items() :
+            counts[int(categoryId)] = max(counts.get(int(categoryId), 0) + delta, 0)
+        return counts
+
+    def getCountsByFeatureNames(self, featureNames):
+        for featureName in featureNames :
+            for categoryId, count in self.__featureCounts.get(featureName, {}).items() :
+                yield featureName, categoryId, count
+
+    '''
+    The counts of a feature keyed by category id, not to be modified
+    '''
+    def getFeatureCounts(self, featureName):
+        return self.__featureCounts.get(featureName) or {}
+
+    def getDocumentCounts(self):
+        return dict(self.__documentCounts)
+
+    def getNumDocumentsForCategory(self, categoryId):
+        return self.__documentCounts.get(categoryId, 0)
+
+    def getNumberOfDocuments(self):
+        return len(self.__documents)
+
+    def getVersion(self):
+        return self.__version
+
+    '''
+    The index reads the counts straight from the store, only the categories are
+    cached and the index is replaced when the version changes
+    '''
+    def getClassifierIndex(self, features):
+        index = self.__classifierIndex
+        if index is None or index.getVersion() != self.__version :
+            index = self.__classifierIndex = MemoryClassifierIndex(self)
+        return index
+
+
+'''
+Classifier index over a MemoryCountStore
+'''
+class MemoryClassifierIndex(ClassifierIndex):
+
+    def __init__(self, countStore):
+        super(MemoryClassifierIndex, self).__init__()
+        self.__countStore = countStore
+        self.__version = countStore.getVersion()
+        self.__categories = sorted(countStore.getAllCategories(), key=lambda category: category.id)
+
+    def getVersion(self):
+        return self.__version
+
+    def _getCountStore(self):
+        return self.__countStore
+
+    def getCategories(self):
+        return self.__categories
+
+    def loadNumberOfDocuments(self):
+        pass
+
+    def loadAllDocumentCounts(self):
+        pass
+
+    def loadFeatureCountsForCategories(self, features, categoryIds=[0]):
+        pass
+
+    def getNumDocumentsForCategory(self, category):
+        return self.__countStore.getNumDocumentsForCategory(category.id)
+
+    def getNumberOfDocuments(self):
+        return self.__countStore.getNumberOfDocuments()
+
+    def getFeatureCounts(self, featureName):
+        return self.__countStore.getFeatureCounts(featureName)
+
+    def getFeatureCategoryCount(self, featureName, category):
+        return self.__countStore.getFeatureCounts(featureName).get(category.id, 0)
+
+    def getTotalFeatureCount(self, featureName, categoriesYesNo) :
+        counts = self.__countStore.getFeatureCounts(featureName)
+        return counts.get(categoriesYesNo[0].id, 0) + counts.get(categoriesYesNo[1].id, 0)
@@ -0,0 +1,314 @@
+'''
+Tests of training and classification, run with manage.py test classifier
+'''
+from classifier import FeatureExtractor
+from classifier.classifiers import BayesianClassifier, FisherBayesClassifier, ClassifierIndex
+from classifier.models import CategoryRegistry, Document, FeatureCategoryCount, CategoryDocumentCount
+from classifier.stores import MemoryCountStore
+from classifier.trainer import Trainer
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+import re
+import StringIO
+import sys
+import threading
+
+FOOD_CORPORA = [
+    "pizza pasta cheese tomato dinner",
+    "burger fries ketchup lunch",
+    "pasta sauce garlic cheese dinner",
+    "salad tomato cheese lunch",
+]
+
+TRAVEL_CORPORA = [
+    "flight hotel paris airport",
+    "train ticket rome hotel",
+    "airport flight luggage passport",
+    "beach hotel holiday flight",
+]
+
+'''
+Trains the food and travel corpora, each labeled yes for its own tag and no for the other
+'''
+def trainCorpora(trainer):
+    for corpus in FOOD_CORPORA :
+        assert trainer.train(corpus, ["food"], ["travel"])
+    for corpus in TRAVEL_CORPORA :
+        assert trainer.train(corpus, ["travel"], ["food"])
+
+'''
+A classifier that tags by comparing the yes and no probabilities only
+'''
+def getClassifier(classifierClass, countStore=None):
+    classifier = classifierClass()
+    classifier.setSnapshotPath(None)
+    classifier.setUseCompactIndex(False)
+    classifier.setCountStore(countStore)
+    for tagName in ("food", "travel") :
+        for yes in (True, False) :
+            classifier.setMinThreshold(tagName, yes, 0.0)
+    return classifier
+
+
+class TrainClassifyTest(TestCase):
+
+    def setUp(self):
+        # The registry and the shared index outlive the rolled back test transactions
+        CategoryRegistry.getSharedRegistry().invalidate()
+        ClassifierIndex.resetSharedIndex()
+        self.trainer = Trainer()
+
+    def tearDown(self):
+        CategoryRegistry.getSharedRegistry().invalidate()
+        ClassifierIndex.resetSharedIndex()
+
+    def getCategoryIds(self, tagName):
+        yes, no = CategoryRegistry.getSharedRegistry().getCategoryPairs([tagName])[tagName]
+        return yes.id, no.id
+
+    def getFeatureCounts(self, corpus):
+        features = FeatureExtractor.getSharedExtractor().getFeatures(corpus)
+        counts = {}
+        for featureName, categoryId, count in FeatureCategoryCount.getCountsByFeatureNames(features) :
+            if count :
+                counts[(featureName, categoryId)] = count
+        return counts
+
+    def getDocumentCounts(self):
+        return dict((categoryId, count) for categoryId, count in CategoryDocumentCount.getDocumentCounts().items() if count)
+
+    def testClassify(self):
+        trainCorpora(self.trainer)
+        for classifierClass in (BayesianClassifier, FisherBayesClassifier) :
+            classifier = getClassifier(classifierClass)
+            self.assertEqual(dict(classifier.classify("cheese pizza with tomato for dinner")),
+                             {"food" : True, "travel" : False})
+            self.assertEqual(dict(classifier.classify("hotel near the airport before the flight")),
+                             {"food" : False, "travel" : True})
+
+    def testClassifyWithoutSharedIndex(self):
+        trainCorpora(self.trainer)
+        for classifierClass in (BayesianClassifier, FisherBayesClassifier) :
+            classifier = getClassifier(classifierClass)
+            classifier.setUseSharedIndex(False)
+            self.assertEqual(dict(classifier.classify("cheese pizza with tomato for dinner")),
+                             {"food" : True, "travel" : False})
+
+    def testClassifyMany(self):
+        trainCorpora(self.trainer)
+        classifier = getClassifier(FisherBayesClassifier)
+        corpora = ["garlic pasta lunch", "passport and luggage for the flight"]
+        self.assertEqual(classifier.classifyMany(corpora), [classifier.classify(corpus) for corpus in corpora])
+
+    def testTrainCounts(self):
+        trainCorpora(self.trainer)
+        foodYes, foodNo = self.getCategoryIds("food")
+        travelYes, travelNo = self.getCategoryIds("travel")
+        self.assertEqual(Document.objects.count(), 8)
+        self.assertEqual(self.getDocumentCounts(), {foodYes : 4, foodNo : 4, travelYes : 4, travelNo : 4})
+
+        hotel = FeatureExtractor.getSharedExtractor().getFeatures("hotel")[0]
+        self.assertEqual(self.getFeatureCounts("hotel"), {(hotel, travelYes) : 3, (hotel, foodNo) : 3})
+
+    def testTrainTwice(self):
+        self.assertTrue(self.trainer.train(FOOD_CORPORA[0], ["food"], ["travel"]))
+        self.assertTrue(self.trainer.train(FOOD_CORPORA[0], ["food"], ["travel"]))
+        foodYes, _ = self.getCategoryIds("food")
+        self.assertEqual(Document.objects.count(), 1)
+        self.assertEqual(self.getDocumentCounts()[foodYes], 1)
+
+    def testTrainMany(self):
+        documents = [(corpus, ["food"], ["travel"]) for corpus in FOOD_CORPORA]
+        batches = []
+        self.assertEqual(self.trainer.trainMany(documents, batchSize=3, onBatch=batches.append), len(FOOD_CORPORA))
+        self.assertEqual(batches, [3, 1])
+        self.assertEqual(self.trainer.trainMany(documents), 0)
+
+        foodYes, _ = self.getCategoryIds("food")
+        _, travelNo = self.getCategoryIds("travel")
+        cheese = FeatureExtractor.getSharedExtractor().getFeatures("cheese")[0]
+        self.assertEqual(self.getDocumentCounts(), {foodYes : 4, travelNo : 4})
+        self.assertEqual(self.getFeatureCounts("cheese"), {(cheese, foodYes) : 3, (cheese, travelNo) : 3})
+
+    def testRepeatedTagsCountOnce(self):
+        corpus = FOOD_CORPORA[0]
+        self.assertTrue(self.trainer.train(corpus, ["food", "food"], ["travel", "travel"]))
+        foodYes, _ = self.getCategoryIds("food")
+        _, travelNo = self.getCategoryIds("travel")
+        self.assertEqual(self.getDocumentCounts(), {foodYes : 1, travelNo : 1})
+
+        self.assertTrue(self.trainer.untrain(corpus))
+        self.assertEqual(self.getDocumentCounts(), {})
+        self.assertEqual(self.getFeatureCounts(corpus), {})
+
+    def testUntrainRestoresCounts(self):
+        trainCorpora(self.trainer)
+        corpus = "pizza flight to rome"
+        documentCounts = self.getDocumentCounts()
+        featureCounts = self.getFeatureCounts(corpus)
+
+        self.assertTrue(self.trainer.train(corpus, ["food", "travel"]))
+        self.assertNotEqual(self.getFeatureCounts(corpus), featureCounts)
+        self.assertTrue(self.trainer.untrain(corpus))
+        self.assertEqual(self.getDocumentCounts(), documentCounts)
+        self.assertEqual(self.getFeatureCounts(corpus), featureCounts)
+        self.assertEqual(Document.objects.count(), 8)
+
+    def testUntrainByDocumentId(self):
+        corpus = FOOD_CORPORA[0]
+        self.assertTrue(self.trainer.train(corpus, ["food"]))
+        document = Document.getDocumentByHash(Document.getHash(corpus))
+        self.assertTrue(self.trainer.untrain(documentId=document.id))
+        self.assertEqual(Document.objects.count(), 0)
+        self.assertEqual(self.getFeatureCounts(corpus), {})
+
+    def testRelabel(self):
+        corpus = FOOD_CORPORA[0]
+        self.assertTrue(self.trainer.train(corpus, ["food"], ["travel"]))
+        document = Document.getDocumentByHash(Document.getHash(corpus))
+        self.assertTrue(self.trainer.relabel(document.id, ["travel"], ["food"]))
+
+        foodYes, foodNo = self.getCategoryIds("food")
+        travelYes, travelNo = self.getCategoryIds("travel")
+        pizza = FeatureExtractor.getSharedExtractor().getFeatures("pizza")[0]
+        self.assertEqual(self.getDocumentCounts(), {travelYes : 1, foodNo : 1})
+        self.assertEqual(self.getFeatureCounts("pizza"), {(pizza, travelYes) : 1, (pizza, foodNo) : 1})
+
+    def testDocumentWithoutCounts(self):
+        corpus = FOOD_CORPORA[0]
+        document = Document.getDocumentByCorpus(corpus, create=True)
+        self.assertTrue(self.trainer.train(corpus, ["food"], ["travel"]))
+        self.assertEqual(Document.objects.count(), 1)
+        self.assertEqual(self.getDocumentCounts(), {})
+
+        self.assertTrue(self.trainer.relabel(document.id, ["food"]))
+        foodYes, _ = self.getCategoryIds("food")
+        self.assertEqual(self.getDocumentCounts(), {foodYes : 1})
+        self.assertTrue(self.trainer.untrain(corpus))
+        self.assertEqual(self.getDocumentCounts(), {})
+        self.assertEqual(self.getFeatureCounts(corpus), {})
+        self.assertEqual(Document.objects.count(), 0)
+
+    def testRelabelMissingDocument(self):
+        self.assertTrue(self.trainer.relabel(12345, ["food"]))
+        self.assertTrue(self.trainer.untrain(documentId=12345))
+        self.assertEqual(self.getDocumentCounts(), {})
+
+
+class ConcurrencyTest(TestCase):
+
+    def setUp(self):
+        CategoryRegistry.getSharedRegistry().invalidate()
+        ClassifierIndex.resetSharedIndex()
+
+    def tearDown(self):
+        CategoryRegistry.getSharedRegistry().invalidate()
+        ClassifierIndex.resetSharedIndex()
+
+    '''
+    One classifier sharing the extractor and the index with many threads gives the same
+    results as a single thread.  The test database isn't visible from other threads, so
+    the shared index is warmed with all the features first and its version checks are
+    paused while the threads run.
+    '''
+    @override_settings(CLASSIFIER_INDEX_CHECK_INTERVAL=float('inf'))
+    def testSharedClassifier(self):
+        trainCorpora(Trainer())
+        corpora = FOOD_CORPORA + TRAVEL_CORPORA + ["cheese pizza with tomato for dinner",
+                                                   "hotel near the airport before the flight"]
+        for classifierClass in (BayesianClassifier, FisherBayesClassifier) :
+            classifier = getClassifier(classifierClass)
+            expected = [classifier.classify(corpus) for corpus in corpora]
+            mismatches = []
+            errors = []
+
+            def classifyAll():
+                try :
+                    for _ in range(20) :
+                        for corpus, tags in zip(corpora, expected) :
+                            if classifier.classify(corpus) != tags :
+                                mismatches.append(corpus)
+                except Exception, ex :
+                    errors.append(ex)
+
+            threads = [threading.Thread(target=classifyAll) for _ in range(8)]
+            for thread in threads :
+                thread.start()
+            for thread in threads :
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(mismatches, [])
+
+
+class MemoryCountStoreTest(TestCase):
+
+    def setUp(self):
+        self.store = MemoryCountStore()
+        self.trainer = Trainer()
+        self.trainer.setCountStore(self.store)
+
+    def testClassify(self):
+        trainCorpora(self.trainer)
+        self.assertEqual(self.store.getNumberOfDocuments(), 8)
+        for classifierClass in (BayesianClassifier, FisherBayesClassifier) :
+            classifier = getClassifier(classifierClass, self.store)
+            self.assertEqual(dict(classifier.classify("cheese pizza with tomato for dinner")),
+                             {"food" : True, "travel" : False})
+            self.assertEqual(dict(classifier.classify("hotel near the airport before the flight")),
+                             {"food" : False, "travel" : True})
+
+    def testRollback(self):
+        trainCorpora(self.trainer)
+        documentCounts = self.store.getDocumentCounts()
+        numCategories = len(self.store.getAllCategories())
+
+        def failingAddCounts(featureDeltas, categoryDeltas, documentsDelta):
+            raise ValueError("Failed to write the counts")
+        self.store.addCounts = failingAddCounts
+        self.assertFalse(self.trainer.train("pizza in the museum", ["food", "art"], ["travel"]))
+        del self.store.addCounts
+
+        self.assertEqual(self.store.getNumberOfDocuments(), 8)
+        self.assertEqual(self.store.getDocumentCounts(), documentCounts)
+        self.assertEqual(len(self.store.getAllCategories()), numCategories)
+        self.assertTrue(self.trainer.train("pizza in the museum", ["food", "art"], ["travel"]))
+        self.assertEqual(self.store.getNumberOfDocuments(), 9)
+
+
+'''
+Runs classify_bench on a tiny corpus.  The command creates and destroys its own test
+database, so it doesn't run inside a test transaction.
+'''
+class BenchCommandTest(TransactionTestCase):
+
+    def setUp(self):
+        CategoryRegistry.getSharedRegistry().invalidate()
+        ClassifierIndex.resetSharedIndex()
+
+    def tearDown(self):
+        CategoryRegistry.getSharedRegistry().invalidate()
+        ClassifierIndex.resetSharedIndex()
+
+    def testBench(self):
+        stdout = sys.stdout
+        sys.stdout = output = StringIO.StringIO()
+        try :
+            call_command('classify_bench', documents=20, classify_documents=5, vocabulary=50, categories=3, threads=2)
+        finally :
+            sys.stdout = stdout
+
+        lines = output.getvalue().splitlines()
+        expected = [
+            r"Startup: import [\d.]+ ms, peak memory \d+ KB, first extraction [\d.]+ ms, peak memory \d+ KB$",
+            r"Corpus: 20 documents, 50 words, 3 categories$",
+            r"Trainer.train: +[\d.]+ docs/sec, +[\d.]+ queries/doc, peak memory \d+ KB$",
+            r"Trainer.trainMany: +[\d.]+ docs/sec, +[\d.]+ queries/doc, peak memory \d+ KB$",
+        ]
+        for classifierClass in (BayesianClassifier, FisherBayesClassifier) :
+            expected.append(r"%s.classify: p50 [\d.]+ ms, p95 [\d.]+ ms, p99 [\d.]+ ms, [\d.]+ queries/doc, "
+                            r"peak memory \d+ KB$" % classifierClass.__name__)
+            expected.append(r"%s.classify x 2 threads: +[\d.]+ docs/sec, 0 errors$" % classifierClass.__name__)
+        self.assertEqual(len(lines), len(expected), lines)
+        for line, pattern in zip(lines, expected) :
+            self.assertTrue(re.match(pattern, line), "%r doesn't match %r" % (line, pattern))
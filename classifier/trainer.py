@@ -4,28 +4,30 @@ Created on Feb 10, 2012
 @author: Dannie
 '''
 from classifier import FeatureExtractor
-from classifier.models import ClassifierCategory, Document, FeatureCounts, \
-    DocumentCategoryCounts, CategoryDocumentCountIndex
-from django.db import transaction
-from json.decoder import JSONDecoder
-from json.encoder import JSONEncoder
+from classifier.models import Document
+from classifier.stores import DjangoCountStore
 import logging
 
 '''
 Deal Trainer.
+All counts are read and written through a count store, the database by default.
 '''
 class Trainer(object):
     
     categories = {}
     
     def __init__(self):
-        self._jsonDecoder = JSONDecoder()
-        self._jsonEncoder = JSONEncoder()
-        self.__featureExtractor = FeatureExtractor()
+        self.__featureExtractor = FeatureExtractor.getSharedExtractor()
+        self.__countStore = DjangoCountStore.getSharedStore()
     
     def setFeatureExtractor(self, featureExtractor):
-        self.__featuredExtractor = featureExtractor
+        self.__featureExtractor = featureExtractor
         
+    '''
+    Trains into the given count store (see classifier.stores) instead of the database
+    '''
+    def setCountStore(self, countStore):
+        self.__countStore = countStore
         
     def __isNumeric(self, feature):
         isNumeric = False
@@ -37,144 +39,257 @@ class Trainer(object):
         return isNumeric
 
     '''
-    Given a list of yes category names, retrieves the yes/no category hash that the trainer needs
+    Given a list of yes category names, retrieves the yes/no category hash that the trainer needs.
+    A tag repeated in the names is counted once.
     '''
     def __getCategoriesFromNames(self, yesTagNames, noTagNames):
         finalCategories = []
         
         #create the categories if they don't already exist
-        for tagName in yesTagNames :
-            if tagName :
-                categoryYes,_ = ClassifierCategory.objects.get_or_create(categoryName=tagName, yes=True)
-                categoryNo,_ = ClassifierCategory.objects.get_or_create(categoryName=tagName, yes=False)
-    
-                finalCategories.append(categoryYes)
-        for tagName in noTagNames :
-            if tagName :
-                categoryYes,_ = ClassifierCategory.objects.get_or_create(categoryName=tagName, yes=True)
-                categoryNo,_ = ClassifierCategory.objects.get_or_create(categoryName=tagName, yes=False)
-                
-                finalCategories.append(categoryNo)
+        categoryPairs = self.__countStore.getCategoryPairs(
+            [tagName for tagName in list(yesTagNames or []) + list(noTagNames or []) if tagName])
+        categoryIds = set()
+        for tagNames, isYes in ((yesTagNames, True), (noTagNames, False)) :
+            for tagName in tagNames or [] :
+                if tagName :
+                    category = categoryPairs[tagName][0 if isYes else 1]
+                    if category.id not in categoryIds :
+                        categoryIds.add(category.id)
+                        finalCategories.append(category)
 
         return finalCategories 
-
+    
     '''
     Trains a corpus of data.
     '''
-    @transaction.commit_manually   
     def train(self, corpus="", yesTagNames=None, noTagNames=None):
         logger = logging.getLogger("Trainer.train")
         success = False
         
         categories = []
+        self.__countStore.begin()
         try :
-            document = Document.getDocumentByCorpus(corpus)
+            corpusHash = Document.getHash(corpus)
+            document = self.__countStore.getTrainedDocument(corpusHash=corpusHash)
             if not document :
-                features = self.__featuredExtractor.getFeatures(corpus)
+                features = self.__featureExtractor.getFeatures(corpus)
                 categories = self.__getCategoriesFromNames(yesTagNames, noTagNames)
 
-                document = Document(corpus=corpus)
-                document.save()
                 documentCounts = {}
                 for category in categories :
                     self.__incrementCategoryCount(documentCounts, category)
-                DocumentCategoryCounts(document=document, countData=self._jsonEncoder.encode(documentCounts)).save()
+                self.__countStore.addDocuments([(corpus, corpusHash, documentCounts, features)])
                 
-                for feature in features :
-                    featureCount,_ = FeatureCounts.objects.get_or_create(featureName=feature)
-                    counts = self._jsonDecoder.decode(featureCount.countData) if featureCount.countData else {}
-                    
-                    for category in categories :
-                        self.__incrementCategoryCount(counts, category)
-                            
-                    featureCount.countData = self._jsonEncoder.encode(counts)
-                    featureCount.save()
-                        
-                #We keep an index of category document counts for faster classification later on
-                catDocCountIndex = CategoryDocumentCountIndex.getCountIndex()
-                index = self._jsonDecoder.decode(catDocCountIndex.countData) if catDocCountIndex.countData else {}
-                for category in categories :
-                    self.__incrementCategoryCount(index, category)
-                catDocCountIndex.countData = self._jsonEncoder.encode(index)
-                catDocCountIndex.save()
+                categoryDeltas = dict((category.id, 1) for category in categories)
+                featureDeltas = dict((feature, categoryDeltas) for feature in features)
+                self.__countStore.addCounts(featureDeltas, categoryDeltas, 1)
                     
                 success = True
-                
-                transaction.commit()
             else :
-                logger.info("Document already exists: " + str(document.id) + " - " + document.corpusHash)
+                logger.info("Document already exists: " + str(document.documentId) + " - " + document.corpusHash)
                 success = True
+                
+            self.__countStore.commit()
     
         except Exception, ex :
             logger.info("Bad data:%s" % corpus)
             logger.exception("Failed to save the trained data: " + str(ex))
-            transaction.rollback()
+            self.__countStore.rollback()
+            success = False
         
         return success
 
     
+    '''
+    Trains many documents at once.  Takes an iterable of (corpus, yesTagNames, noTagNames) 
+    tuples, the feature and category counts of each batch are merged in memory and 
+    written with grouped count updates in a single transaction.
+    Documents whose features were already extracted elsewhere can be passed as 
+    (corpus, yesTagNames, noTagNames, features).
+    onBatch, when given, is called with the number of newly trained documents of each
+    batch once it is committed.
+    Returns the number of newly trained documents.
+    '''
+    def trainMany(self, documents, batchSize=500, onBatch=None):
+        logger = logging.getLogger("Trainer.trainMany")
+        
+        numTrained = 0
+        batch = []
+        for document in documents :
+            batch.append(document)
+            if len(batch) >= batchSize :
+                numTrained += self.__trainBatch(batch, onBatch)
+                batch = []
+        if batch :
+            numTrained += self.__trainBatch(batch, onBatch)
+            
+        logger.info("Trained %d documents" % numTrained)
+        return numTrained
+    
+    def __trainBatch(self, batch, onBatch=None):
+        logger = logging.getLogger("Trainer.trainMany")
+        numTrained = 0
+        
+        self.__countStore.begin()
+        try :
+            # Skip documents that are already trained or repeated within the batch
+            pending = {}
+            for document in batch :
+                corpus, yesTagNames, noTagNames = document[:3]
+                features = document[3] if len(document) > 3 else None
+                if corpus :
+                    pending.setdefault(Document.getHash(corpus), (corpus, yesTagNames or [], noTagNames or [], features))
+            for corpusHash in self.__countStore.getTrainedHashes(pending.keys()) :
+                pending.pop(corpusHash, None)
+            
+            if pending :
+                # Resolve the categories of the whole batch at once
+                tagNames = set()
+                for corpus, yesTagNames, noTagNames, features in pending.values() :
+                    tagNames.update(yesTagNames)
+                    tagNames.update(noTagNames)
+                self.__countStore.getCategoryPairs([tagName for tagName in tagNames if tagName])
+                
+                featureDeltas = {}
+                documentCounts = {}
+                newDocuments = []
+                for corpusHash, (corpus, yesTagNames, noTagNames, features) in pending.items() :
+                    categories = self.__getCategoriesFromNames(yesTagNames, noTagNames)
+                    counts = {}
+                    for category in categories :
+                        self.__incrementCategoryCount(documentCounts, category)
+                        self.__incrementCategoryCount(counts, category)
+                    
+                    if features is None :
+                        features = self.__featureExtractor.getFeatures(corpus)
+                    newDocuments.append((corpus, corpusHash, counts, features))
+                    for feature in features :
+                        featureCounts = featureDeltas.setdefault(feature, {})
+                        for category in categories :
+                            self.__incrementCategoryCount(featureCounts, category)
+                
+                self.__countStore.addDocuments(newDocuments)
+                self.__countStore.addCounts(featureDeltas, documentCounts, len(pending))
+                
+                numTrained = len(pending)
+            
+            self.__countStore.commit()
+        except Exception, ex :
+            logger.exception("Failed to save the trained batch: " + str(ex))
+            self.__countStore.rollback()
+            numTrained = 0
+        
+        if onBatch is not None :
+            onBatch(numTrained)
+        return numTrained
+    
     '''
     Helper function to increment the category count
     '''
     def __incrementCategoryCount(self, dict, category):
-        id = str(category.id)
+        id = category.id
         if not dict.get(id) :
             dict[id] = 1
         else :
             dict[id] += 1
-            
-    def __decrementCategoryCount(self, dict, category):
-        id = str(category.id)
-        if dict.get(id) and dict[id] > 0 :
-            dict[id] -= 1
+
     
     
     '''
     Untrains a corpus of data ... assuming it exists in the system.
+    The document can also be given by its id or corpus hash, the features stored
+    when it was trained are used instead of extracting them again.
+    Returns False only if untraining failed, a document that doesn't exist is left alone.
     ''' 
-    @transaction.commit_manually   
-    def untrain(self, corpus=""):
+    def untrain(self, corpus="", documentId=None, corpusHash=None):
         logger = logging.getLogger("Trainer.untrain")
         success = False
 
+        self.__countStore.begin()
         try :
-            document = Document.getDocumentByCorpus(corpus)
+            document = self.__getDocument(corpus, documentId, corpusHash)
             
             if document :
-                categories = DocumentCategoryCounts.getCategoriesForDocument(document)
-                features = self.__featuredExtractor.getFeatures(corpus)
-                document.delete()
+                features = document.features
+                if features is None :
+                    features = self.__featureExtractor.getFeatures(document.corpus)
+                self.__countStore.removeDocument(document)
                 
-                for feature in features :
-                    featureCount,_ = FeatureCounts.objects.get_or_create(featureName=feature)
-                    counts = self._jsonDecoder.decode(featureCount.countData) if featureCount.countData else {}
-                    
-                    for category in categories :
-                        self.__decrementCategoryCount(counts, category)
-                            
-                    featureCount.countData = self._jsonEncoder.encode(counts)
-                    featureCount.save()
-                        
-                #We keep an index of category document counts for faster classification later on
-                catDocCountIndex = CategoryDocumentCountIndex.getCountIndex()
-                index = self._jsonDecoder.decode(catDocCountIndex.countData) if catDocCountIndex.countData else {}
-                for category in categories :
-                    self.__decrementCategoryCount(index, category)
-                catDocCountIndex.countData = self._jsonEncoder.encode(index)
-                catDocCountIndex.save()
+                categoryDeltas = dict((categoryId, -1) for categoryId in document.categoryCounts)
+                featureDeltas = dict((feature, categoryDeltas) for feature in features)
+                self.__countStore.addCounts(featureDeltas, categoryDeltas, -1)
                 
                 success = True
-                
-                transaction.commit()
                     
             else :
                 logger.info("Document doesn't exist")
                 success = True
+                
+            self.__countStore.commit()
         except Exception, ex :
             logger.exception("Failed to untrain the document: " + str(ex))
-            transaction.rollback()
+            self.__countStore.rollback()
+            success = False
             
         return success
+    
+    '''
+    Changes the labels of an already trained document.  Only the categories that 
+    differ from the current labels are untrained/trained, using the stored features,
+    in a single transaction.  document is a Document or a document id.
+    Like untrain, returns False only if relabeling failed, a document that doesn't
+    exist is left alone.
+    '''
+    def relabel(self, document, yesTagNames=None, noTagNames=None):
+        logger = logging.getLogger("Trainer.relabel")
+        success = False
+        
+        self.__countStore.begin()
+        try :
+            if isinstance(document, Document) :
+                document = document.id
+            document = self.__getDocument(documentId=document)
             
-
-    
\ No newline at end of file
+            if document :
+                oldCategoryIds = set(document.categoryCounts)
+                newCategories = self.__getCategoriesFromNames(yesTagNames or [], noTagNames or [])
+                newCategoryIds = set(category.id for category in newCategories)
+                
+                categoryDeltas = {}
+                for categoryId in oldCategoryIds - newCategoryIds :
+                    categoryDeltas[categoryId] = -1
+                for categoryId in newCategoryIds - oldCategoryIds :
+                    categoryDeltas[categoryId] = 1
+                
+                if categoryDeltas :
+                    features = document.features
+                    if features is None :
+                        features = self.__featureExtractor.getFeatures(document.corpus)
+                    
+                    counts = {}
+                    for category in newCategories :
+                        self.__incrementCategoryCount(counts, category)
+                    self.__countStore.setDocumentCategories(document, counts, features)
+                    
+                    featureDeltas = dict((feature, categoryDeltas) for feature in features)
+                    self.__countStore.addCounts(featureDeltas, categoryDeltas, 0)
+                
+                success = True
+            else :
+                logger.info("Document doesn't exist")
+                success = True
+            
+            self.__countStore.commit()
+        except Exception, ex :
+            logger.exception("Failed to relabel the document: " + str(ex))
+            self.__countStore.rollback()
+            success = False
+            
+        return success
+    
+    def __getDocument(self, corpus="", documentId=None, corpusHash=None):
+        if documentId is not None :
+            return self.__countStore.getTrainedDocument(documentId=documentId)
+        if not corpusHash :
+            corpusHash = Document.getHash(corpus)
+        return self.__countStore.getTrainedDocument(corpusHash=corpusHash)
@@ -15,7 +15,7 @@ setup(
     description='General text classifier',
     long_description=open('README.txt').read(),
     install_requires=[
-        "Django >= 1.2",
+        "Django >= 1.4",
         'nltk'
     ],
 )
\ No newline at end of file